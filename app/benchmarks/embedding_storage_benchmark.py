@@ -0,0 +1,115 @@
+"""
+Compares the size of stored embeddings against nearest neighbour recall for the EmbeddingCodec
+formats, and for PCA reduction, to pick index_embedding_cache_format.
+
+Usage:
+    python app/benchmarks/embedding_storage_benchmark.py
+    python app/benchmarks/embedding_storage_benchmark.py --cache_path app/embedding_cache/embeddings.sqlite3
+
+Without --cache_path, clustered synthetic 1536 dimension embeddings are generated.
+Recall@k is the share of each query's exact float32 top k that the compressed vectors also rank top k.
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.embedding_storage_service import EmbeddingCodec
+
+
+def synthetic_embeddings(count, dimension, clusters=200, seed=0):
+    # Real embeddings are anisotropic and clustered, unlike uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    weights = np.linspace(3, 0.2, dimension, dtype=np.float32)
+    embeddings = centers[rng.integers(0, clusters, count)] * weights
+    embeddings += rng.standard_normal((count, dimension)).astype(np.float32) * weights * 0.6
+    return normalize(embeddings)
+
+
+def load_cached_embeddings(cache_path, count):
+    connection = sqlite3.connect(cache_path)
+    rows = connection.execute(
+        "SELECT embedding, storage_format FROM embeddings LIMIT ?", [count]
+    ).fetchall()
+    return normalize(np.stack([EmbeddingCodec.decode(fmt, blob) for blob, fmt in rows]))
+
+
+def normalize(embeddings):
+    return embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-10)
+
+
+def top_k(queries, embeddings, k):
+    scores = queries @ embeddings.T
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def recall_at_k(exact, approximate):
+    return np.mean(
+        [len(set(a) & set(b)) / len(a) for a, b in zip(exact, approximate)]
+    )
+
+
+def codec_roundtrip(embeddings, storage_format):
+    codec = EmbeddingCodec(storage_format)
+    blobs = [codec.encode(embedding) for embedding in embeddings]
+    decoded = np.stack([EmbeddingCodec.decode(storage_format, blob) for blob in blobs])
+    return decoded, len(blobs[0])
+
+
+def pca_projection(embeddings, dimensions):
+    mean = embeddings.mean(axis=0)
+    _, _, components = np.linalg.svd(embeddings - mean, full_matrices=False)
+    return mean, components[:dimensions]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_path", help="EmbeddingCache to read real embeddings from.")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.cache_path:
+        embeddings = load_cached_embeddings(args.cache_path, args.count + args.queries)
+    else:
+        embeddings = synthetic_embeddings(args.count + args.queries, args.dimension)
+    queries, embeddings = embeddings[: args.queries], embeddings[args.queries :]
+    exact = top_k(queries, embeddings, args.k)
+    dimension = embeddings.shape[1]
+    list_bytes = sys.getsizeof(embeddings[0].tolist()) + dimension * sys.getsizeof(1.0)
+    print(f"{len(embeddings)} embeddings of {dimension} dimensions, {len(queries)} queries")
+    print(f"{'list of floats':22} {list_bytes:7} bytes/vector")
+
+    for storage_format in EmbeddingCodec.storage_formats:
+        start_time = time.perf_counter()
+        decoded, blob_bytes = codec_roundtrip(embeddings, storage_format)
+        elapsed = time.perf_counter() - start_time
+        recall = recall_at_k(exact, top_k(queries, decoded, args.k))
+        cosine = np.mean(np.sum(normalize(decoded) * embeddings, axis=1))
+        print(
+            f"{storage_format:22} {blob_bytes:7} bytes/vector  recall@{args.k}: {recall:.4f}  "
+            f"mean cosine to original: {cosine:.6f}  roundtrip: {len(embeddings) / elapsed:,.0f} vectors/s"
+        )
+
+    # PCA only helps local search; vectors upserted to the index must keep their full dimension
+    for dimensions in (128, 256, 512):
+        if dimensions >= dimension:
+            continue
+        mean, components = pca_projection(embeddings, dimensions)
+        reduced = normalize((embeddings - mean) @ components.T)
+        reduced_queries = normalize((queries - mean) @ components.T)
+        for storage_format in EmbeddingCodec.storage_formats:
+            decoded, blob_bytes = codec_roundtrip(reduced, storage_format)
+            recall = recall_at_k(exact, top_k(reduced_queries, decoded, args.k))
+            label = f"pca {dimensions} {storage_format}"
+            print(f"{label:22} {blob_bytes:7} bytes/vector  recall@{args.k}: {recall:.4f}")
+
+
+if __name__ == "__main__":
+    main()
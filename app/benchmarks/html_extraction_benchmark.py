@@ -0,0 +1,138 @@
+"""
+Compares pages per second of the lxml extractors in html_extraction_service against
+the BeautifulSoup html.parser extractors they replaced.
+
+Usage:
+    python app/benchmarks/html_extraction_benchmark.py
+    python app/benchmarks/html_extraction_benchmark.py --fixtures_dir path/to/saved/html --processes 4
+
+Without --fixtures_dir, synthetic documentation pages are generated.
+"""
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.html_extraction_service import (
+    extract_sitemap_page,
+    extract_gitbook_page,
+    extract_generic_page,
+)
+
+
+# Extractors as they were before html_extraction_service, used as the baseline
+def bs4_sitemap_page(html_text):
+    soup = BeautifulSoup(html_text, "html.parser")
+    title = soup.title.get_text() if soup.title else ""
+    content_element = soup.find(id="content-container")
+    if not content_element:
+        content_element = soup.find(id="content")
+    if not content_element:
+        return title, ""
+    unwanted_elements = content_element.select(
+        '[style*="visibility: hidden"], [class*="toc"]'
+    )
+    for element in unwanted_elements:
+        element.decompose()
+    for header in content_element.find_all("header"):
+        header.decompose()
+    return title, content_element.get_text(separator=" ")
+
+
+def bs4_gitbook_page(html_text):
+    soup = BeautifulSoup(html_text, "html.parser")
+    content = soup.find("main")
+    if not content:
+        return "", ""
+    title_element = content.find("h1")
+    title = title_element.get_text() if title_element else ""
+    return title, content.get_text(separator="\n").strip()
+
+
+def bs4_generic_page(html_text):
+    soup = BeautifulSoup(html_text, "html.parser")
+    title = soup.title.get_text() if soup.title else ""
+    text_element = soup.find(id="content")
+    return title, text_element.get_text() if text_element else ""
+
+
+EXTRACTORS = {
+    "sitemap": (bs4_sitemap_page, extract_sitemap_page),
+    "gitbook": (bs4_gitbook_page, extract_gitbook_page),
+    "generic": (bs4_generic_page, extract_generic_page),
+}
+
+
+def synthetic_page(page_number, sections=40):
+    nav = "".join(f"<li><a href='/docs/{i}'>Page {i}</a></li>" for i in range(200))
+    body = "".join(
+        f"<h2 id='s{i}'>Section {i}</h2><p>Paragraph {i} of page {page_number} with <code>inline code</code>, "
+        f"<a href='/docs/{i}'>a link</a> and <b>some emphasis</b>. The quick brown fox jumps over the lazy dog.</p>"
+        f"<pre><code>def example_{i}():\n    return {i}</code></pre>"
+        for i in range(sections)
+    )
+    return f"""<!DOCTYPE html><html><head><title>Docs page {page_number}</title>
+<script>var analytics = {{"page": {page_number}}};</script><style>body {{ color: black; }}</style></head>
+<body><nav><ul>{nav}</ul></nav>
+<main><div id="content"><header><h1>Docs page {page_number}</h1></header>
+<div class="toc-sidebar"><ul><li>Section 1</li><li>Section 2</li></ul></div>
+<div style="visibility: hidden">hidden text</div>{body}</div></main>
+<footer>Footer text</footer></body></html>"""
+
+
+def load_fixtures(fixtures_dir, page_count):
+    if not fixtures_dir:
+        return [synthetic_page(i) for i in range(page_count)]
+    pages = []
+    for file_name in sorted(os.listdir(fixtures_dir)):
+        if file_name.endswith((".html", ".htm")):
+            with open(os.path.join(fixtures_dir, file_name), "r", encoding="utf-8") as f:
+                pages.append(f.read())
+    return pages
+
+
+def pages_per_second(extractor, pages, executor=None):
+    start_time = time.perf_counter()
+    if executor is None:
+        results = [extractor(page) for page in pages]
+    else:
+        results = list(executor.map(extractor, pages, chunksize=8))
+    return len(pages) / (time.perf_counter() - start_time), results
+
+
+def normalized(results):
+    # Whitespace is collapsed during preprocessing so it isn't compared
+    return [(" ".join(title.split()), " ".join(text.split())) for title, text in results]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures_dir", help="Directory of saved .html pages.")
+    parser.add_argument("--pages", type=int, default=200, help="Synthetic page count.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    pages = load_fixtures(args.fixtures_dir, args.pages)
+    print(f"{len(pages)} pages, {sum(len(page) for page in pages) / 1e6:.1f} MB")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
+        for target_type, (baseline, extractor) in EXTRACTORS.items():
+            baseline_rate, baseline_results = pages_per_second(baseline, pages)
+            lxml_rate, lxml_results = pages_per_second(extractor, pages)
+            pool_rate, _ = pages_per_second(extractor, pages, executor)
+            matching = sum(
+                a == b
+                for a, b in zip(normalized(baseline_results), normalized(lxml_results))
+            )
+            print(
+                f"{target_type:8} bs4: {baseline_rate:8.1f} pages/s  lxml: {lxml_rate:8.1f} pages/s "
+                f"({lxml_rate / baseline_rate:.1f}x)  lxml x{args.processes} processes: {pool_rate:8.1f} pages/s  "
+                f"same text: {matching}/{len(pages)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -45,11 +45,22 @@ class DeploymentConfig:
                 ceq_doc_relevancy_check_enabled: bool = True
                 ceq_doc_relevancy_check_llm_model: str = None
                 ceq_embedding_model: str = None
+                ceq_embedding_backend: str = None
+                ceq_embedding_local_model: str = None
                 ceq_tiktoken_encoding_model: str = None
                 ceq_docs_to_retrieve: int = None
+                ceq_mmr_enabled: bool = True
+                ceq_mmr_lambda: float = None
+                ceq_mmr_fetch_multiplier: int = None
+                ceq_federated_sources: list = None
+                ceq_federated_timeout_seconds: float = None
+                ceq_federated_score_normalization: str = None
                 ceq_docs_max_token_length: int = None
                 ceq_docs_max_total_tokens: int = None
                 ceq_docs_max_used: int = None
+                ceq_merge_overlapping_docs_enabled: bool = True
+                ceq_merge_overlapping_docs_min_chars: int = None
+                ceq_docs_compression_enabled: bool = True
                 ceq_main_prompt_llm_model: str = None
                 ceq_max_response_tokens: int = None
                 openai_timeout_seconds: float = None
@@ -78,11 +89,22 @@ class DeploymentConfig:
                 ceq_doc_relevancy_check_enabled: bool = True
                 ceq_doc_relevancy_check_llm_model: str = None
                 ceq_embedding_model: str = None
+                ceq_embedding_backend: str = None
+                ceq_embedding_local_model: str = None
                 ceq_tiktoken_encoding_model: str = None
                 ceq_docs_to_retrieve: int = None
+                ceq_mmr_enabled: bool = True
+                ceq_mmr_lambda: float = None
+                ceq_mmr_fetch_multiplier: int = None
+                ceq_federated_sources: list = None
+                ceq_federated_timeout_seconds: float = None
+                ceq_federated_score_normalization: str = None
                 ceq_docs_max_token_length: int = None
                 ceq_docs_max_total_tokens: int = None
                 ceq_docs_max_used: int = None
+                ceq_merge_overlapping_docs_enabled: bool = True
+                ceq_merge_overlapping_docs_min_chars: int = None
+                ceq_docs_compression_enabled: bool = True
                 ceq_main_prompt_llm_model: str = None
                 ceq_max_response_tokens: int = None
                 openai_timeout_seconds: float = None
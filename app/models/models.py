@@ -47,11 +47,27 @@ class ShelbyModel:
     ceq_doc_relevancy_check_enabled: bool = False
     ceq_doc_relevancy_check_llm_model: str = "gpt-4"
     ceq_embedding_model: str = "text-embedding-ada-002"
+    # "openai" or "local". Must match the index's index_embedding_backend and model
+    ceq_embedding_backend: str = "openai"
+    ceq_embedding_local_model: str = "sentence-transformers/all-mpnet-base-v2"
     ceq_tiktoken_encoding_model: str = "text-embedding-ada-002"
     ceq_docs_to_retrieve: int = 5
+    ceq_mmr_enabled: bool = False
+    ceq_mmr_lambda: float = 0.5
+    ceq_mmr_fetch_multiplier: int = 4
+    # List of dicts to query instead of the deployment's index. Each may set "index_name", "namespace", "timeout_seconds",
+    # "environment" and "api_key_secret" (name of the secret holding that project's Pinecone key, read from
+    # {DEPLOYMENT_NAME}_{API_KEY_SECRET} like other secrets), and "filter" to replace the doc_type and data_domain
+    # filters, which foreign indexes may not have the metadata for. "filter": None queries without a filter.
+    ceq_federated_sources: list = None
+    ceq_federated_timeout_seconds: float = 5.0
+    ceq_federated_score_normalization: str = "rrf"
     ceq_docs_max_token_length: int = 1200
     ceq_docs_max_total_tokens: int = 3500
     ceq_docs_max_used: int = 5
+    ceq_merge_overlapping_docs_enabled: bool = False
+    ceq_merge_overlapping_docs_min_chars: int = 50
+    ceq_docs_compression_enabled: bool = False
     ceq_main_prompt_llm_model: str = "gpt-4"
     ceq_max_response_tokens: int = 300
     openai_timeout_seconds: float = 180.0
@@ -158,15 +174,64 @@ class IndexModel:
     index_embedding_model: str = "text-embedding-ada-002"
     index_tiktoken_encoding_model: str = "text-embedding-ada-002"
     index_embedding_max_chunk_size: int = 8191
+    # Max texts per embedding request
     index_embedding_batch_size: int = 100
+    index_embedding_batch_max_tokens: int = 50000
+    index_embedding_requests_per_minute: int = 3000
+    index_embedding_tokens_per_minute: int = 1000000
+    # Concurrent embedding requests, halved on rate limit errors
+    index_embedding_max_concurrency: int = 4
+    # "openai" or "local". Local runs index_embedding_local_model on CPU with sentence-transformers
+    # Its dimension must match index_vectorstore_dimension, e.g. 768 for all-mpnet-base-v2
+    index_embedding_backend: str = "openai"
+    index_embedding_local_model: str = "sentence-transformers/all-mpnet-base-v2"
+    index_embedding_local_batch_size: int = 32
+    # Encoding processes used by local ingestion. 0 encodes in the ingest thread
+    index_embedding_local_processes: int = 0
+    # Used by dry runs to estimate the cost of an ingest
+    index_embedding_cost_per_1k_tokens: float = 0.0001
+    index_embedding_cache_enabled: bool = True
+    index_embedding_cache_path: str = "app/embedding_cache/embeddings.sqlite3"
+    # "float32" or "int8". int8 is 4x smaller but cached vectors are then upserted dequantized,
+    # at ~0.98 recall@10 in app/benchmarks/embedding_storage_benchmark.py
+    index_embedding_cache_format: str = "float32"
     index_vectorstore_dimension: int = 1536
-    index_vectorstore_upsert_batch_size: int = 20
+    # Upsert batches are capped by count and serialized size
+    index_vectorstore_upsert_batch_size: int = 100
+    index_vectorstore_upsert_max_bytes: int = 1500000
+    # Embedding values are rounded before upsert. None sends them unrounded
+    index_vectorstore_value_decimals: int = 6
+    index_vectorstore_delete_batch_size: int = 1000
     index_vectorstore_metric: str = "cosine"
     index_vectorstore_pod_type: str = "p1"
+    index_migration_batch_size: int = 1000
+    # Data sources ingested at once. 1 ingests serially
+    index_ingest_max_workers: int = 1
+    # Concurrent upsert requests shared by all data sources
+    index_vectorstore_max_concurrency: int = 4
+    # Chunks per streaming ingest batch, and batches buffered between stages
+    index_ingest_batch_size: int = 500
+    index_ingest_queue_size: int = 4
+    # Near-duplicate chunks within a data source are indexed once, listing the other urls in duplicate_urls
+    index_dedup_enabled: bool = True
+    # Estimated Jaccard similarity of the chunks' word shingles
+    index_dedup_threshold: float = 0.85
+    # Keeps duplicate_urls well under Pinecone's metadata size limit
+    index_dedup_max_urls: int = 50
+    # Web crawler for sitemap, gitbook and generic sources
+    index_crawler_max_connections: int = 20
+    index_crawler_max_per_host: int = 4
+    index_crawler_timeout_seconds: float = 30.0
+    index_crawler_max_depth: int = 2
+    index_crawler_cache_path: str = "app/crawler_cache/http_cache.sqlite3"
+    # Processes for html extraction and document cleaning and splitting. 0 runs them in the ingest threads
+    index_preprocessor_processes: int = 0
     index_preprocessor_min_length: int = 150
     # index_text_splitter_goal_length: int = 500
     index_text_splitter_goal_length: int = 750
     index_text_splitter_overlap_percent: int = 15 # In percent
+    # "dfs" or "dp". dp finds the chunking closest to goal_length, but changes existing chunk boundaries
+    index_text_splitter_segmenter: str = "dfs"
     index_openai_timeout_seconds: float = 180.0
     index_indexed_metadata = [
         "data_domain_name",
@@ -16,6 +16,9 @@ def main():
     Arguments:
         --run: Run the main service
         --index_management: Run index_agent with the settings in the index_description.yaml and models.py files.
+        --migrate_index_layout: Re-home existing vectors after changing index_namespace_layout.
+        --resume: With --index_management, continue an interrupted ingest from its checkpoints.
+        --dry_run: With --index_management, report chunks, tokens, cost and time without indexing.
 
     Usage:
         python your_script.py --index_management [deployment_name]
@@ -31,6 +34,10 @@ def main():
     group.add_argument(
         "--index_management", help="Run index_agent."
     )
+    group.add_argument(
+        "--migrate_index_layout",
+        help="Move a deployment's vectors into the namespaces for its index_namespace_layout.",
+    )
     group.add_argument(
         "--aggregate", help="Run aggregate service."
     )
@@ -46,6 +53,18 @@ def main():
         help="Run deployment from specified deployment name.",
     )
 
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="With --index_management, continue an interrupted ingest from its checkpoints.",
+    )
+
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="With --index_management, report chunks, tokens, cost and time without indexing.",
+    )
+
     # check if any arguments were provided
     if len(sys.argv) == 1:
         ### Add deployment name here if you're too lazy to use the CLI ###
@@ -76,12 +95,17 @@ def main():
         
         config_module_path = f"deployments.{service_name}.deployment_config"
         config_module = import_module(config_module_path)
-        deployment = DeploymentInstance(config_module, run_index_management)
+        deployment = DeploymentInstance(
+            config_module, run_index_management, dry_run=bool(args.dry_run)
+        )
         
         ### Right now we don't have index_agent set up for anything but manual input ###
 
         # Add documents to the vectorstore based on what's enabled in index_description.yaml
-        deployment.index_agent.ingest_docs()
+        if args.dry_run:
+            deployment.index_agent.plan_ingest()
+        else:
+            deployment.index_agent.ingest_docs(resume=args.resume)
         
         # Clears all documents in your vectorstore based on the deployment name (namespace)
         # deployment.index_agent.clear_deplyoment()
@@ -92,6 +116,12 @@ def main():
         # Deletes index requiring a complete reboot
         # deployment.index_agent.delete_index()
             
+    elif args.migrate_index_layout:
+        config_module_path = f"deployments.{args.migrate_index_layout}.deployment_config"
+        config_module = import_module(config_module_path)
+        deployment = DeploymentInstance(config_module, run_index_management=True)
+        deployment.index_agent.migrate_namespace_layout()
+        sys.exit()
     elif args.make_deployment:
         DeploymentMaker(args.make_deployment)
         sys.exit()
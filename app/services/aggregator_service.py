@@ -13,8 +13,10 @@ import time
 from services.tiny_jmap_library.tiny_jmap_library import TinyJMAPClient
 from services.data_processing_service import TextProcessing
 from services.log_service import Logger
+from services.embedding_cache_service import EmbeddingCache, CachedEmbeddings
+from services.embedding_service import create_embedding_retriever
+from services.vectorstore_service import VectorUpserter
 from bs4 import BeautifulSoup
-from langchain.embeddings import OpenAIEmbeddings
 import pinecone
 from models.models import IndexModel
 
@@ -576,18 +578,32 @@ class VectorIndex:
             )
 
         self.vectorstore = pinecone.Index(self.main_ag.config.index_name)
+        self.vector_upserter = VectorUpserter(
+            self.vectorstore,
+            max_batch_size=self.index_config.index_vectorstore_upsert_batch_size,
+            max_batch_bytes=self.index_config.index_vectorstore_upsert_max_bytes,
+            max_concurrency=self.index_config.index_vectorstore_max_concurrency,
+            value_decimals=self.index_config.index_vectorstore_value_decimals,
+            print_and_log=self.main_ag.log.print_and_log,
+        )
 
-        self.embedding_retriever = OpenAIEmbeddings(
-            model=self.index_config.index_embedding_model,
-            openai_api_key=os.environ.get("OPENAI_API_KEY"),
-            chunk_size=self.index_config.index_embedding_batch_size,
-            request_timeout=self.index_config.index_openai_timeout_seconds,
+        self.embedding_retriever = create_embedding_retriever(
+            self.index_config,
+            os.environ.get("OPENAI_API_KEY"),
+            self.main_ag.log.print_and_log,
         )
+        if self.index_config.index_embedding_cache_enabled:
+            self.embedding_retriever = CachedEmbeddings(
+                self.embedding_retriever,
+                EmbeddingCache(
+                    self.index_config.index_embedding_cache_path,
+                    self.index_config.index_embedding_cache_format,
+                ),
+                self.embedding_retriever.model,
+                self.main_ag.log.print_and_log,
+            )
 
     def upsert_email_text(self, content):
-        self.main_ag.log.print_and_log(
-            f"Initial index stats: {self.vectorstore.describe_index_stats()}\n"
-        )
         index_resource_stats = self.vectorstore.describe_index_stats(
             filter={"target_type": {"$eq": "email_text"}}
         )
@@ -625,11 +641,8 @@ class VectorIndex:
             vectors_to_upsert.append(prepared_vector)
 
         self.main_ag.log.print_and_log(f"Upserting {len(vectors_to_upsert)} vectors")
-        self.vectorstore.upsert(
-            vectors=vectors_to_upsert,
-            namespace=self.main_ag.config.index_namespace,
-            batch_size=self.index_config.index_vectorstore_upsert_batch_size,
-            show_progress=True,
+        self.vector_upserter.upsert(
+            vectors_to_upsert, self.main_ag.config.index_namespace
         )
 
         index_resource_stats = self.vectorstore.describe_index_stats(
@@ -0,0 +1,65 @@
+import os
+import json
+import threading
+
+
+class IngestCheckpoint:
+    """Append-only JSONL log of a data source's progress through an ingest run.
+    Records each document's chunks and the ids of each embedded and upserted batch so a
+    resumed run can skip the work already done. Removed once the source's ingest completes.
+    With no checkpoint_path nothing is written, as in a dry run.
+    """
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+        self.chunks_by_source = {}
+        self.embedded_ids = set()
+        self.upserted_ids = set()
+        self.needs_legacy_clear = False
+        self.legacy_cleared = False
+
+    def load(self):
+        """Returns True if there was a checkpoint to resume from."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be partial if the run was killed mid write
+                    break
+                match record["stage"]:
+                    case "started":
+                        self.needs_legacy_clear = record["needs_legacy_clear"]
+                    case "chunked":
+                        self.chunks_by_source[record["source"]] = record["chunks"]
+                    case "embedded":
+                        self.embedded_ids.update(record["ids"])
+                    case "upserted":
+                        self.upserted_ids.update(record["ids"])
+                    case "legacy_cleared":
+                        self.legacy_cleared = True
+        return True
+
+    def record(self, stage, **fields):
+        if not self.checkpoint_path:
+            return
+        line = json.dumps({"stage": stage, **fields}, ensure_ascii=False)
+        with self.lock:
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        with self.lock:
+            if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+        self.chunks_by_source = {}
+        self.embedded_ids = set()
+        self.upserted_ids = set()
+        self.needs_legacy_clear = False
+        self.legacy_cleared = False
@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+
+
+class ChunkManifest:
+    """Single file record of the chunks indexed for a data source.
+    Maps chunk_id to its content hash, metadata hash and token count. It's loaded once into a dict
+    so change detection is a set difference, and it's rewritten atomically.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        # None until loaded, and stays None if there's no manifest on disk
+        self.chunks = None
+        # Measured by the last ingest, used to estimate dry runs
+        self.vectors_per_second = None
+
+    @staticmethod
+    def create_entry(data_source_name, text_chunk, document_chunk, token_count=None):
+        """Returns the chunk's stable id and its manifest entry.
+        The id is a hash of the embedded text, so inserting a paragraph only changes the ids of the chunks it touches.
+        """
+        content_hash = hashlib.sha256(text_chunk.encode("utf-8")).hexdigest()
+        chunk_id = f"id-{data_source_name}-{content_hash[:32]}"
+        entry = {
+            "content_hash": content_hash,
+            "metadata_hash": ChunkManifest.metadata_hash(document_chunk),
+            "token_count": token_count,
+        }
+        return chunk_id, entry
+
+    @staticmethod
+    def metadata_hash(document_chunk):
+        return hashlib.sha256(
+            json.dumps(document_chunk, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            self.chunks = None
+            return self.chunks
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        chunks = manifest["chunks"]
+        self.vectors_per_second = manifest.get("vectors_per_second")
+        # Older manifests stored only the metadata hash
+        self.chunks = {
+            chunk_id: entry
+            if isinstance(entry, dict)
+            else {"content_hash": None, "metadata_hash": entry, "token_count": None}
+            for chunk_id, entry in chunks.items()
+        }
+        return self.chunks
+
+    def diff(self, current_chunks):
+        """Returns (new_ids, changed_metadata_ids, removed_ids) against the loaded manifest."""
+        previous_chunks = self.chunks or {}
+        current_ids = current_chunks.keys()
+        previous_ids = previous_chunks.keys()
+        new_ids = current_ids - previous_ids
+        removed_ids = previous_ids - current_ids
+        changed_metadata_ids = {
+            chunk_id
+            for chunk_id in current_ids & previous_ids
+            if current_chunks[chunk_id]["metadata_hash"]
+            != previous_chunks[chunk_id]["metadata_hash"]
+        }
+        return new_ids, changed_metadata_ids, removed_ids
+
+    def write(self, chunks, vectors_per_second=None):
+        # Written to a temp file and renamed so a crash never leaves a partial manifest
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        if vectors_per_second is not None:
+            self.vectors_per_second = vectors_per_second
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"chunks": chunks, "vectors_per_second": self.vectors_per_second}, f
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.manifest_path)
+        self.chunks = chunks
@@ -0,0 +1,89 @@
+import os
+import json
+import mmap
+
+
+class ChunkStore:
+    """Compact local copy of a data source's chunks in one JSONL file.
+    Each line is {"id", "chunk"} and the last line is an index of {chunk_id: [offset, length]}.
+    The file is written to a temp path and renamed into place, so readers see either the
+    old store or the new one. Reads use mmap and only parse the lines they need.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.file = None
+        self.mmap = None
+        self.index = None
+        self.data_end = 0
+
+    def write(self, chunks):
+        """Writes (chunk_id, document_chunk) pairs in order. Returns the number of chunks written."""
+        os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+        temp_path = f"{self.store_path}.tmp"
+        index = {}
+        offset = 0
+        with open(temp_path, "wb") as f:
+            for chunk_id, document_chunk in chunks:
+                line = json.dumps(
+                    {"id": chunk_id, "chunk": document_chunk}, ensure_ascii=False
+                ).encode("utf-8")
+                f.write(line + b"\n")
+                # Duplicate ids keep the first occurrence
+                index.setdefault(chunk_id, [offset, len(line)])
+                offset += len(line) + 1
+            f.write(json.dumps({"index": index}).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.store_path)
+        return len(index)
+
+    def open(self):
+        """Maps the store into memory. Returns False if it doesn't exist yet."""
+        self.close()
+        if not os.path.exists(self.store_path):
+            return False
+        self.file = open(self.store_path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # The index is everything after the last newline
+        self.data_end = self.mmap.rfind(b"\n") + 1
+        self.index = json.loads(self.mmap[self.data_end :])["index"]
+        return True
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.file.close()
+        self.file = None
+        self.mmap = None
+        self.index = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __contains__(self, chunk_id):
+        return self.index is not None and chunk_id in self.index
+
+    def __len__(self):
+        return len(self.index) if self.index is not None else 0
+
+    def get(self, chunk_id):
+        if chunk_id not in self:
+            return None
+        offset, length = self.index[chunk_id]
+        return json.loads(self.mmap[offset : offset + length])["chunk"]
+
+    def iter_chunks(self):
+        """Yields (chunk_id, document_chunk) in the order they were written."""
+        if self.mmap is None:
+            return
+        offset = 0
+        while offset < self.data_end:
+            line_end = self.mmap.find(b"\n", offset, self.data_end)
+            line = json.loads(self.mmap[offset:line_end])
+            yield line["id"], line["chunk"]
+            offset = line_end + 1
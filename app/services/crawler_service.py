@@ -0,0 +1,441 @@
+import os
+import re
+import zlib
+import queue
+import sqlite3
+import asyncio
+import threading
+from collections import deque
+from typing import Iterator
+from urllib.parse import urljoin, urldefrag
+import xml.etree.ElementTree as ET
+import aiohttp
+from langchain.schema import Document
+
+_END = object()
+
+
+class HttpCache:
+    """On-disk cache of page bodies with their ETag/Last-Modified validators.
+    New responses are staged per data source and only used for conditional requests
+    once commit() is called after that source's ingest succeeds.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body BLOB NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS pending_pages (
+                    source TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body BLOB NOT NULL,
+                    PRIMARY KEY (source, url)
+                )"""
+            )
+            # Sitemap <lastmod> values as of each source's last successful ingest
+            for table in ["lastmods", "pending_lastmods"]:
+                self.connection.execute(
+                    f"""CREATE TABLE IF NOT EXISTS {table} (
+                        source TEXT NOT NULL,
+                        url TEXT NOT NULL,
+                        lastmod TEXT NOT NULL,
+                        PRIMARY KEY (source, url)
+                    )"""
+                )
+            self.connection.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, last_modified, body FROM pages WHERE url = ?", [url]
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, body = row
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": zlib.decompress(body).decode("utf-8"),
+        }
+
+    def get_pending_body(self, source, url):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body FROM pending_pages WHERE source = ? AND url = ?",
+                [source, url],
+            ).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+    def stage(self, source, url, etag, last_modified, body):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pending_pages (source, url, etag, last_modified, body) VALUES (?, ?, ?, ?, ?)",
+                [source, url, etag, last_modified, zlib.compress(body.encode("utf-8"))],
+            )
+            self.connection.commit()
+
+    def get_lastmods(self, source):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT url, lastmod FROM lastmods WHERE source = ?", [source]
+            ).fetchall()
+        return dict(rows)
+
+    def stage_lastmods(self, source, lastmods):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pending_lastmods (source, url, lastmod) VALUES (?, ?, ?)",
+                [(source, url, lastmod) for url, lastmod in lastmods.items()],
+            )
+            self.connection.commit()
+
+    def commit(self, source):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, body) SELECT url, etag, last_modified, body FROM pending_pages WHERE source = ?",
+                [source],
+            )
+            # Replaced as a whole so urls dropped from the sitemap are forgotten
+            has_pending_lastmods = self.connection.execute(
+                "SELECT 1 FROM pending_lastmods WHERE source = ? LIMIT 1", [source]
+            ).fetchone()
+            if has_pending_lastmods:
+                self.connection.execute(
+                    "DELETE FROM lastmods WHERE source = ?", [source]
+                )
+                self.connection.execute(
+                    "INSERT INTO lastmods (source, url, lastmod) SELECT source, url, lastmod FROM pending_lastmods WHERE source = ?",
+                    [source],
+                )
+            self.discard_pending(source)
+            self.connection.commit()
+
+    def discard(self, source):
+        with self.lock:
+            self.discard_pending(source)
+            self.connection.commit()
+
+    def discard_pending(self, source):
+        # Callers hold the lock
+        for table in ["pending_pages", "pending_lastmods"]:
+            self.connection.execute(f"DELETE FROM {table} WHERE source = ?", [source])
+
+
+class WebCrawler:
+    """Fetches pages concurrently with aiohttp, reusing connections and capping requests per host.
+    Re-crawls send conditional requests from the HttpCache. Pages that answer 304 and already
+    have chunks from the last run are yielded as not_modified documents without being parsed.
+    """
+
+    def __init__(
+        self,
+        http_cache,
+        cache_source,
+        extractor,
+        max_connections=20,
+        max_per_host=4,
+        timeout_seconds=30.0,
+        max_retries=2,
+        queue_size=32,
+        print_and_log=None,
+    ):
+        self.http_cache = http_cache
+        # Data source name that staged responses are committed under
+        self.cache_source = cache_source
+        # Takes page html and returns (title, text)
+        self.extractor = extractor
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.queue_size = queue_size
+        self.print_and_log = print_and_log or print
+        # Urls with chunks from the last run, set by the loader before each crawl
+        self.known_urls = set()
+        # Optional process pool for extraction. The extractor must then be a module level function
+        self.extraction_executor = None
+        # Resumed crawls reuse pages fetched by the interrupted run
+        self.resume = False
+        # <lastmod> of each url in the sitemap being crawled
+        self.sitemap_lastmods = {}
+
+    def lazy_load_urls(self, urls) -> Iterator[Document]:
+        return self.run_crawl(lambda session: self.crawl(session, list(urls)))
+
+    def lazy_load_sitemap(self, sitemap_url, filter_urls=None) -> Iterator[Document]:
+        async def crawl_sitemap(session):
+            entries = await self.fetch_sitemap_entries(session, sitemap_url)
+            entries = [
+                (loc, lastmod)
+                for loc, lastmod in entries
+                if self.matches_filters(loc, filter_urls)
+            ]
+            previous_lastmods = self.http_cache.get_lastmods(self.cache_source)
+            self.sitemap_lastmods = {loc: lastmod for loc, lastmod in entries if lastmod}
+
+            # Pages whose lastmod hasn't moved aren't requested at all
+            urls_to_fetch = []
+            unchanged_lastmods = {}
+            for loc, lastmod in entries:
+                if (
+                    lastmod
+                    and previous_lastmods.get(loc) == lastmod
+                    and loc in self.known_urls
+                ):
+                    unchanged_lastmods[loc] = lastmod
+                else:
+                    urls_to_fetch.append(loc)
+            # Fetched pages stage their lastmod in fetch() only once they succeed,
+            # so a page that falls back to its cached copy is requested again next run
+            self.http_cache.stage_lastmods(self.cache_source, unchanged_lastmods)
+            for loc in unchanged_lastmods:
+                if not await self.put(self.not_modified_document(loc)):
+                    return
+            self.print_and_log(
+                f"Sitemap lists {len(entries)} matching urls, {len(entries) - len(urls_to_fetch)} unchanged by lastmod"
+            )
+            await self.crawl(session, urls_to_fetch)
+
+        return self.run_crawl(crawl_sitemap)
+
+    def lazy_load_recursive(self, start_url, max_depth=2) -> Iterator[Document]:
+        return self.run_crawl(
+            lambda session: self.crawl(
+                session, [start_url], max_depth=max_depth, url_prefix=start_url
+            )
+        )
+
+    def commit(self):
+        self.http_cache.commit(self.cache_source)
+
+    @staticmethod
+    def not_modified_document(url):
+        # Tells ingest to carry forward the page's chunks from the last run
+        return Document(
+            page_content="",
+            metadata={"source": url, "loc": url, "not_modified": True},
+        )
+
+    @staticmethod
+    def matches_filters(url, filter_urls):
+        # Same semantics as langchain's SitemapLoader filter_urls
+        filter_urls = [f for f in filter_urls or [] if f]
+        if not filter_urls:
+            return True
+        return any(re.match(f, url) for f in filter_urls)
+
+    def run_crawl(self, crawl_function):
+        """Runs the async crawl on its own thread and yields documents as they're ready.
+        The bounded queue blocks the crawl when the consumer falls behind.
+        """
+        output = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                asyncio.run(self.run_session(crawl_function, output, stop))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                while not stop.is_set():
+                    try:
+                        output.put(_END, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+
+        if not self.resume:
+            self.http_cache.discard(self.cache_source)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                document = output.get()
+                if document is _END:
+                    break
+                yield document
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            thread.join()
+
+    async def run_session(self, crawl_function, output, stop):
+        self.output = output
+        self.stop = stop
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, limit_per_host=self.max_per_host
+        )
+        timeout = aiohttp.ClientTimeout(total=self.timeout_seconds)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            await crawl_function(session)
+
+    async def put(self, document):
+        # Waits for room in the output queue off the event loop
+        def blocking_put():
+            while not self.stop.is_set():
+                try:
+                    self.output.put(document, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        return await asyncio.get_running_loop().run_in_executor(None, blocking_put)
+
+    async def crawl(self, session, start_urls, max_depth=None, url_prefix=None):
+        # Follows links only when max_depth is set
+        visited = set(start_urls)
+        to_visit = deque((url, 0) for url in start_urls)
+        pending = set()
+        try:
+            while to_visit or pending:
+                # Keeps a bounded number of pages in flight
+                while to_visit and len(pending) < self.max_connections:
+                    url, depth = to_visit.popleft()
+                    pending.add(
+                        asyncio.create_task(
+                            self.process_page(
+                                session, url, depth, follow_links=max_depth is not None
+                            )
+                        )
+                    )
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Checked for every finished task so none are left unretrieved
+                task_errors = [task.exception() for task in done if task.exception()]
+                if task_errors:
+                    raise task_errors[0]
+                for task in done:
+                    document, links, depth = task.result()
+                    if document is not None and not await self.put(document):
+                        return
+                    if max_depth is None or depth + 1 >= max_depth:
+                        continue
+                    for link in links:
+                        if link not in visited and link.startswith(url_prefix):
+                            visited.add(link)
+                            to_visit.append((link, depth + 1))
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def process_page(self, session, url, depth, follow_links=False):
+        body, changed = await self.fetch(session, url)
+        if body is None:
+            return None, [], depth
+        links = self.extract_links(url, body) if follow_links else []
+        if not changed and url in self.known_urls:
+            return self.not_modified_document(url), links, depth
+        title, text = await asyncio.get_running_loop().run_in_executor(
+            self.extraction_executor, self.extractor, body
+        )
+        document = Document(
+            page_content=text, metadata={"source": url, "loc": url, "title": title}
+        )
+        return document, links, depth
+
+    async def fetch(self, session, url):
+        """Returns (body, changed). A 304 or a failed fetch returns the cached body as unchanged."""
+        if self.resume:
+            pending_body = self.http_cache.get_pending_body(self.cache_source, url)
+            if pending_body is not None:
+                self.stage_sitemap_lastmod(url)
+                return pending_body, True
+        cached = self.http_cache.get(url)
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 304 and cached is not None:
+                        self.stage_sitemap_lastmod(url)
+                        return cached["body"], False
+                    response.raise_for_status()
+                    body = await response.text(errors="replace")
+                    self.http_cache.stage(
+                        self.cache_source,
+                        url,
+                        response.headers.get("ETag"),
+                        response.headers.get("Last-Modified"),
+                        body,
+                    )
+                    self.stage_sitemap_lastmod(url)
+                    return body, True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt < self.max_retries:
+                    await asyncio.sleep(2**attempt)
+                    continue
+                # Keeping the cached copy avoids deleting a page's chunks over a transient error
+                if cached is not None:
+                    self.print_and_log(
+                        f"Failed to fetch {url}: {error!r}. Using cached copy."
+                    )
+                    return cached["body"], False
+                self.print_and_log(f"Failed to fetch {url}: {error!r}")
+                return None, False
+
+    def stage_sitemap_lastmod(self, url):
+        lastmod = self.sitemap_lastmods.get(url)
+        if lastmod:
+            self.http_cache.stage_lastmods(self.cache_source, {url: lastmod})
+
+    async def fetch_sitemap_entries(self, session, sitemap_url):
+        """Returns [(loc, lastmod)] and follows sitemap indexes."""
+        body, _ = await self.fetch(session, sitemap_url)
+        if body is None:
+            raise ValueError(f"Could not load sitemap: {sitemap_url}")
+        root = ET.fromstring(body.encode("utf-8"))
+        entries = []
+        if root.tag.split("}")[-1] == "sitemapindex":
+            for child_sitemap in root:
+                loc = self.find_child_text(child_sitemap, "loc")
+                if loc:
+                    entries.extend(await self.fetch_sitemap_entries(session, loc))
+            return entries
+        for url_element in root:
+            loc = self.find_child_text(url_element, "loc")
+            if loc:
+                entries.append((loc, self.find_child_text(url_element, "lastmod")))
+        return entries
+
+    @staticmethod
+    def find_child_text(element, tag):
+        # Sitemap elements are namespaced so only the local name is compared
+        for child in element:
+            if child.tag.split("}")[-1] == tag and child.text:
+                return child.text.strip()
+        return None
+
+    @staticmethod
+    def extract_links(page_url, body):
+        links = []
+        for href in re.findall(r'href=["\'](.*?)["\']', body):
+            link, _ = urldefrag(urljoin(page_url, href))
+            if link.startswith("http"):
+                links.append(link)
+        return links
@@ -1,19 +1,48 @@
 import re
+import collections
+import math
 import string
 from urllib.parse import urlparse
-import shutil
 import os
-import json
+import hashlib
+import threading
 from typing import List
 import tiktoken
 import spacy
+import numpy as np
+from services.chunk_manifest_service import ChunkManifest
+from services.chunk_store_service import ChunkStore
+
+
+# One spaCy model per process, see TextProcessing.spacy_nlp
+_spacy_nlp = None
+_spacy_lock = threading.Lock()
+# Loading the encoding per call costs more than encoding a short chunk
+_tiktoken_encoding = None
 
 
 class TextProcessing:
+    @staticmethod
+    def spacy_nlp():
+        """Loads en_core_web_sm once per process.
+        Sentence boundaries come from the parser, which needs tok2vec, so both are kept along with the tagger.
+        Only components that don't affect splitting are excluded. Words only use nlp.tokenizer.
+        """
+        global _spacy_nlp
+        with _spacy_lock:
+            if _spacy_nlp is None:
+                _spacy_nlp = spacy.load(
+                    "en_core_web_sm",
+                    exclude=["attribute_ruler", "lemmatizer", "ner"],
+                )
+        return _spacy_nlp
+
     @staticmethod
     def tiktoken_len(document):
-        tokenizer = tiktoken.encoding_for_model("text-embedding-ada-002")
-        tokens = tokenizer.encode(document, disallowed_special=())
+        global _tiktoken_encoding
+        if _tiktoken_encoding is None:
+            _tiktoken_encoding = tiktoken.encoding_for_model("text-embedding-ada-002")
+        tokens = _tiktoken_encoding.encode(document, disallowed_special=())
         return len(tokens)
 
     @staticmethod
@@ -81,6 +110,55 @@ class TextProcessing:
         return [s for s in splits if s != ""]
 
 
+class TokenPrefixSums:
+    """Token counts of any run of consecutive splits in O(1), after tokenizing each split once.
+    BPE can merge characters across the edge between two splits, so the correction for each edge
+    (tokens of the pair minus tokens of each split) is summed separately. Merges spanning more than
+    two splits aren't corrected, so final chunks are still checked with a full tokenization.
+    """
+
+    def __init__(self, splits, tiktoken_len):
+        self.counts = [tiktoken_len(split) for split in splits]
+        self.token_sums = [0]
+        for count in self.counts:
+            self.token_sums.append(self.token_sums[-1] + count)
+        # edge_sums[k] is the correction for the edges before split k
+        self.edge_sums = [0, 0]
+        for i in range(1, len(splits)):
+            edge_correction = (
+                tiktoken_len(splits[i - 1] + splits[i])
+                - self.counts[i - 1]
+                - self.counts[i]
+            )
+            self.edge_sums.append(self.edge_sums[-1] + edge_correction)
+
+    def length(self, start, end):
+        """Tokens in "".join(splits[start:end])."""
+        if end <= start:
+            return 0
+        return (self.token_sums[end] - self.token_sums[start]) + (
+            self.edge_sums[end] - self.edge_sums[start + 1]
+        )
+
+    @staticmethod
+    def running_lengths(splits, tiktoken_len, reverse=False):
+        """Lazily yields the tokens in the first k splits (the last k if reverse) for k = 1, 2, ...
+        Only tokenizes as far as it's read, for overlaps that use a few splits of a long text.
+        """
+        current_length = 0
+        previous_split = None
+        previous_count = 0
+        for split in reversed(splits) if reverse else splits:
+            count = tiktoken_len(split)
+            current_length += count
+            if previous_split is not None:
+                pair = split + previous_split if reverse else previous_split + split
+                current_length += tiktoken_len(pair) - previous_count - count
+            previous_split = split
+            previous_count = count
+            yield current_length
+
+
 class DFSTextSplitter:
     """Splits text that attempts to split by paragraph, newlines, sentences, spaces, and finally chars.
     Splits with regex for all but sentences and words.
@@ -94,14 +172,21 @@ class DFSTextSplitter:
         goal_length,
         overlap_percent,
         print_and_log,
+        segmenter="dfs",
     ) -> None:
         self.print_and_log = print_and_log
+        # "dfs" takes the first segmentation found, "dp" the one with chunk lengths closest to the goal
+        if segmenter not in ["dfs", "dp"]:
+            raise ValueError(f"Invalid text splitter segmenter: {segmenter}")
+        self.segmenter = segmenter
 
         self.split_with_regex = TextProcessing.split_text_with_regex
-        self.spacy = spacy.load("en_core_web_sm")
         self.tiktoken_len = TextProcessing.tiktoken_len
 
         self.memo = {}
+        # spaCy splits by (separator, text hash), kept for one split_text call
+        self.spacy_cache = {}
+        self.token_prefix_sums = None
         self.original_goal_length = goal_length
         self.goal_length = goal_length
         self.overlap_percent = overlap_percent
@@ -145,13 +230,11 @@ class DFSTextSplitter:
         )
         # self.print_and_log(f"New goal_length: {self.goal_length}")
 
-    def _set_heuristics(self, text, splits):
+    def _set_heuristics(self, splits, total_tokens):
         """Sets some values that we use as a pre-filter to speed up the process."""
         self.average_range_min = 0
-        for split in splits:
-            if self.tiktoken_len(split) > self.max_length:
-                return False
-        total_tokens = self.tiktoken_len(text)
+        if max(self.token_prefix_sums.counts) > self.max_length:
+            return False
 
         estimated_chunks = int(total_tokens / self.goal_length)
         if estimated_chunks == 1:
@@ -173,12 +256,8 @@ class DFSTextSplitter:
                 splits = self.split_with_regex(text, separator, self._keep_separator)
             case "\n":
                 splits = self.split_with_regex(text, separator, self._keep_separator)
-            case "spacy_sentences":
-                doc = self.spacy(text)
-                splits = [sent.text for sent in doc.sents]
-            case "spacy_words":
-                doc = self.spacy(text)
-                splits = [token.text for token in doc]
+            case "spacy_sentences" | "spacy_words":
+                splits = self._spacy_split_many([text], separator)[0]
             case " ":
                 splits = self.split_with_regex(text, separator, self._keep_separator)
             case "":
@@ -191,10 +270,36 @@ class DFSTextSplitter:
             return None
         return splits
 
+    def _spacy_split_many(self, texts, separator):
+        """Returns spaCy's sentence or word splits for each text, batching uncached texts through nlp.pipe."""
+        keys = [
+            (separator, hashlib.sha1(text.encode("utf-8")).digest()) for text in texts
+        ]
+        uncached = {key: text for key, text in zip(keys, texts) if key not in self.spacy_cache}
+        if uncached:
+            nlp = TextProcessing.spacy_nlp()
+            if separator == "spacy_words":
+                docs = (nlp.tokenizer(text) for text in uncached.values())
+            else:
+                docs = nlp.pipe(uncached.values())
+            for key, doc in zip(uncached, docs):
+                if separator == "spacy_words":
+                    self.spacy_cache[key] = [token.text for token in doc]
+                else:
+                    self.spacy_cache[key] = [sent.text for sent in doc.sents]
+        return [self.spacy_cache[key] for key in keys]
+
     def _find_valid_chunk_combinations(self, splits):
         """Initializes the chunk combo finding process."""
 
-        chunks_as_splits = self._recursive_chunk_tester(0, splits)
+        if self.segmenter == "dp":
+            chunks_as_splits = self._optimal_chunk_segmentation(splits)
+        else:
+            try:
+                chunks_as_splits = self._recursive_chunk_tester(0, splits)
+            except RecursionError:
+                # One stack frame per chunk, so documents with very many chunks need the iterative version
+                chunks_as_splits = self._optimal_chunk_segmentation(splits)
 
         if chunks_as_splits is None:
             return None
@@ -232,6 +337,54 @@ class DFSTextSplitter:
         # If no valid chunking found for the current start, return None
         return None
 
+    def _optimal_chunk_segmentation(self, splits):
+        """Dynamic programming over split boundaries, with the same chunk ends the DFS accepts.
+        Picks the segmentation minimizing the squared distance of each chunk from goal_length,
+        less the overlap that's added later. It's iterative, finds each start's valid ends by binary search
+        on the token prefix sums, and returns the same end splits format as _recursive_chunk_tester,
+        or None if no segmentation exists.
+        """
+        last_split = len(splits) - 1
+        min_length = self.goal_length_min_threshold - self.chunk_overlap_max_threshold
+        max_length = self.max_length - self.chunk_overlap_max_threshold
+        target_length = self.goal_length - self.chunk_overlap
+        prefix_sums = self.token_prefix_sums
+        # length(start, end) == end_offsets[end] - start_offsets[start]
+        end_offsets = np.add(prefix_sums.token_sums, prefix_sums.edge_sums)
+        start_offsets = np.add(prefix_sums.token_sums[:-1], prefix_sums.edge_sums[1:])
+
+        # best_costs[start] is the cost of the best segmentation of splits[start:]
+        best_costs = np.full(len(splits), math.inf)
+        best_ends = np.zeros(len(splits), dtype=np.int64)
+        best_costs[last_split] = 0
+        for start in range(last_split - 1, -1, -1):
+            first_end = start + 1 + self.average_range_min
+            end_limit = min(
+                last_split + 1,
+                int(
+                    np.searchsorted(
+                        end_offsets, start_offsets[start] + max_length, side="right"
+                    )
+                ),
+            )
+            if first_end >= end_limit:
+                continue
+            lengths = end_offsets[first_end:end_limit] - start_offsets[start]
+            costs = (lengths - target_length) ** 2 + best_costs[first_end:end_limit]
+            costs[(lengths < min_length) | (lengths > max_length)] = math.inf
+            best = int(np.argmin(costs))
+            best_costs[start] = costs[best]
+            best_ends[start] = first_end + best
+        if best_costs[0] == math.inf:
+            return None
+
+        chunk_end_splits = []
+        start = 0
+        while start != last_split:
+            start = int(best_ends[start])
+            chunk_end_splits.append(start)
+        return chunk_end_splits
+
     def _find_valid_endsplits_for_chunk(self, start, splits):
         """Returns endsplits that are within the threshold of goal_length.
         Uses memoization to save from having to recompute.
@@ -243,12 +396,9 @@ class DFSTextSplitter:
 
         valid_ends = []
 
-        current_length = self.tiktoken_len(
-            "".join(splits[start : start + 1 + self.average_range_min])
-        )
         for j in range(start + 1 + self.average_range_min, len(splits)):
             # Final tokenization will be of combined chunks - not individual chars!
-            current_length = self.tiktoken_len("".join(splits[start:j]))
+            current_length = self.token_prefix_sums.length(start, j)
             if (
                 current_length
                 >= self.goal_length_min_threshold - self.chunk_overlap_max_threshold
@@ -271,6 +421,19 @@ class DFSTextSplitter:
 
         if chunk_end_splits[0] != 0:
             chunk_end_splits.insert(0, 0)  # whoo whoo
+
+        # Overlaps without newlines fall through to spaCy, so their sentences are found in one nlp.pipe batch
+        overlap_texts = [
+            "".join(splits[chunk_end_splits[i] + 1 : chunk_end_splits[i + 1]])
+            for i in range(1, len(chunk_end_splits) - 1)
+        ] + [
+            "".join(splits[chunk_end_splits[i] : chunk_end_splits[i + 1]])
+            for i in range(len(chunk_end_splits) - 1)
+        ]
+        self._spacy_split_many(
+            [text for text in overlap_texts if "\n" not in text], "spacy_sentences"
+        )
+
         # Iterate over chunk_end_splits
         for i, end_split in enumerate(chunk_end_splits):
             forward_overlap_text = ""
@@ -345,16 +508,14 @@ class DFSTextSplitter:
             overlap_splits = self._split_text(overlap_text, separator)
             if overlap_splits is None:
                 continue
-            current_length = 0
-            saved_splits = []
-            for split in overlap_splits:
-                saved_splits.append(split)
-                current_length = self.tiktoken_len("".join(saved_splits))
+            for end, current_length in enumerate(
+                TokenPrefixSums.running_lengths(overlap_splits, self.tiktoken_len),
+                start=1,
+            ):
                 if current_length > overlap_max:
                     break
                 if current_length >= overlap_min:
-                    overlap = "".join(saved_splits)
-                    return overlap
+                    return "".join(overlap_splits[:end])
         return None
 
     def _create_backwards_overlap(
@@ -367,38 +528,42 @@ class DFSTextSplitter:
             overlap_splits = self._split_text(overlap_text, separator)
             if overlap_splits is None:
                 continue
-            current_length = 0
-            saved_splits = []
-            for j in range(len(overlap_splits) - 1, -1, -1):
-                saved_splits.insert(0, overlap_splits[j])
-                current_length = self.tiktoken_len("".join(saved_splits))
+            for count, current_length in enumerate(
+                TokenPrefixSums.running_lengths(
+                    overlap_splits, self.tiktoken_len, reverse=True
+                ),
+                start=1,
+            ):
                 if current_length > overlap_max:
                     break
                 if current_length >= overlap_min:
-                    overlap = "".join(saved_splits)
-                    return overlap
+                    return "".join(overlap_splits[-count:])
         return None
 
     def split_text(self, text) -> List[str]:
         """Interface for class."""
         self._set_thresholds(self.original_goal_length)
+        self.spacy_cache = {}
+        total_tokens = self.tiktoken_len(text)
         # Skip if too small
-        if self.tiktoken_len(text) < self.max_length:
+        if total_tokens < self.max_length:
             self.print_and_log(
-                f"Doc length: {self.tiktoken_len(text)} already within max_length: {self.max_length}"
+                f"Doc length: {total_tokens} already within max_length: {self.max_length}"
             )
             return text
         for separator in self._separators:
             self.print_and_log(f"Trying separator: {repr(separator)}")
             self._set_thresholds(self.original_goal_length)
+            # Splits and their token counts don't depend on the thresholds, so they're computed once per separator
+            splits = self._split_text(text, separator)
+            if splits is not None:
+                self.token_prefix_sums = TokenPrefixSums(splits, self.tiktoken_len)
             while (self.goal_length / self.original_goal_length) > self.min_length:
                 self.memo = {}
-                splits = []
                 chunk_end_splits = None
                 text_chunks = None
-                splits = self._split_text(text, separator)
                 if splits is not None:
-                    if self._set_heuristics(text, splits):
+                    if self._set_heuristics(splits, total_tokens):
                         chunk_end_splits = self._find_valid_chunk_combinations(splits)
                 if chunk_end_splits is not None:
                     text_chunks = self._create_chunks(chunk_end_splits, splits)
@@ -424,7 +589,6 @@ class BalancedRecursiveCharacterTextSplitter:
     ) -> None:
         self.print_and_log = print_and_log
         self._separators = ["\n\n", "\n", "spacy_sentences", " ", ""]
-        self.spacy_sentences = spacy.load("en_core_web_sm")
         self._keep_separator: bool = False
         self.goal_length = goal_length
         self.max_length = max_length or (self.goal_length * 1.25)
@@ -467,7 +631,7 @@ class BalancedRecursiveCharacterTextSplitter:
 
         # Use the current separator to split the text
         if separator == "spacy_sentences":
-            doc = self.spacy_sentences(text)
+            doc = TextProcessing.spacy_nlp()(text)
             splits = [sent.text for sent in doc.sents]
         else:
             splits = TextProcessing.split_text_with_regex(
@@ -538,13 +702,55 @@ class BalancedRecursiveCharacterTextSplitter:
         return ["".join(combo) for combo in final_combos]
 
 
+# One splitter per worker process, reused across data sources with the same settings
+_worker_splitters = {}
+
+
+def get_worker_splitter(goal_length, overlap_percent, segmenter="dfs"):
+    splitter_key = (goal_length, overlap_percent, segmenter)
+    if splitter_key not in _worker_splitters:
+        _worker_splitters[splitter_key] = DFSTextSplitter(
+            goal_length=goal_length,
+            overlap_percent=overlap_percent,
+            print_and_log=print,
+            segmenter=segmenter,
+        )
+    return _worker_splitters[splitter_key]
+
+
+def init_preprocessor_worker(goal_length, overlap_percent, segmenter="dfs"):
+    """ProcessPoolExecutor initializer. Loads tiktoken, spaCy and the splitter once per worker
+    so the first documents don't each pay for the model loads.
+    """
+    TextProcessing.tiktoken_len("")
+    TextProcessing.spacy_nlp()
+    get_worker_splitter(goal_length, overlap_percent, segmenter)
+
+
+def preprocess_text(text, min_length, splitter):
+    """Cleans, measures and splits one document's text.
+    Returns (text, token_count, text_chunks). Texts shorter than min_length aren't split.
+    """
+    text = TextProcessing.strip_excess_whitespace(text)
+    token_count = TextProcessing.tiktoken_len(text)
+    if token_count < min_length:
+        return text, token_count, None
+    return text, token_count, splitter.split_text(text)
+
+
+def preprocess_text_in_worker(text, min_length, goal_length, overlap_percent, segmenter="dfs"):
+    """Runs in a ProcessPoolExecutor worker so only plain strings cross the process boundary."""
+    splitter = get_worker_splitter(goal_length, overlap_percent, segmenter)
+    return preprocess_text(text, min_length, splitter)
+
+
 # Remove starting text whitespace/
 class CEQTextPreProcessor:
     def __init__(self, data_source_config):
         self.index_agent = data_source_config.index_agent
         self.config = data_source_config.index_agent.config
         self.data_source_config = data_source_config
-        self.print_and_log = self.index_agent.log.print_and_log
+        self.print_and_log = data_source_config.print_and_log
         self.tiktoken_encoding_model = self.config.index_tiktoken_encoding_model
 
         self.tiktoken_len = TextProcessing.tiktoken_len
@@ -552,64 +758,27 @@ class CEQTextPreProcessor:
         self.dfs_splitter = DFSTextSplitter(
             goal_length=self.config.index_text_splitter_goal_length,
             overlap_percent=self.config.index_text_splitter_overlap_percent,
-            print_and_log=self.index_agent.log.print_and_log,
+            print_and_log=data_source_config.print_and_log,
+            segmenter=self.config.index_text_splitter_segmenter,
         )
 
-    def run(self, documents) -> []:
+    def run(self, documents, executor=None) -> []:
         processed_document_chunks = []
-        processed_text_chunks = []
-
-        for i, doc in enumerate(documents):
-            # If no doc title use the url and the resource type
-            if not doc.metadata.get("title"):
-                parsed_url = urlparse(doc.metadata.get("loc"))
-                _, tail = os.path.split(parsed_url.path)
-                # Strip anything with "." like ".html"
-                root, _ = os.path.splitext(tail)
-                doc.metadata[
-                    "title"
-                ] = f"{self.data_source_config.data_source_name}: {root}"
-
-            # Remove bad chars and extra whitespace chars
-            doc.page_content = TextProcessing.strip_excess_whitespace(doc.page_content)
-            doc.metadata["title"] = TextProcessing.strip_excess_whitespace(
-                doc.metadata["title"]
-            )
-
-            self.print_and_log(f"Processing: {doc.metadata['title']}")
-
-            if (
-                self.tiktoken_len(doc.page_content)
-                < self.data_source_config.config.index_preprocessor_min_length
-            ):
-                self.print_and_log(
-                    f"🔴 Skipping doc because content length: {self.tiktoken_len(doc.page_content)} is shorter than minimum: { self.data_source_config.config.index_preprocessor_min_length}"
-                )
-                continue
-
-            text_chunks = self.dfs_splitter.split_text(doc.page_content)
-            if text_chunks is None:
-                self.print_and_log("🔴 Something went wrong with the text splitter.")
-                continue
-            # If it's not a list, wrap it inside a list
-            if not isinstance(text_chunks, list):
-                text_chunks = [text_chunks]
-
-            token_counts = [self.tiktoken_len(chunk) for chunk in text_chunks]
-            self.print_and_log(
-                f"🟢 Doc split into {len(text_chunks)} of averge length {int(sum(token_counts) / len(text_chunks))}"
-            )
-
-            for text_chunk in text_chunks:
-                document_chunk, text_chunk = self.append_metadata(text_chunk, doc)
-                processed_document_chunks.append(document_chunk)
-                processed_text_chunks.append(text_chunk.lower())
+        for _, document_chunks, _ in self.process_documents(
+            ((doc, None) for doc in documents), executor
+        ):
+            processed_document_chunks.extend(document_chunks)
 
         self.print_and_log(f"Total docs: {len(documents)}")
         self.print_and_log(f"Total chunks: {len(processed_document_chunks)}")
         if not processed_document_chunks:
             return
-        token_counts = [self.tiktoken_len(chunk) for chunk in processed_text_chunks]
+        token_counts = [
+            self.tiktoken_len(
+                f"{chunk['content']} title: {chunk['title']}".lower()
+            )
+            for chunk in processed_document_chunks
+        ]
         self.print_and_log(f"Min: {min(token_counts)}")
         self.print_and_log(f"Avg: {int(sum(token_counts) / len(token_counts))}")
         self.print_and_log(f"Max: {max(token_counts)}")
@@ -617,6 +786,98 @@ class CEQTextPreProcessor:
 
         return processed_document_chunks
 
+    def process_documents(self, documents, executor=None):
+        """Takes (doc, document_chunks) pairs and yields (doc, document_chunks, processed) in the same order.
+        Only docs whose document_chunks is None are cleaned and split, the rest pass through.
+        With an executor, docs are sharded across its processes, keeping two per process in flight.
+        """
+        min_length = self.config.index_preprocessor_min_length
+        if executor is None:
+            for doc, document_chunks in documents:
+                if document_chunks is not None:
+                    yield doc, document_chunks, False
+                    continue
+                self.prepare_document(doc)
+                result = preprocess_text(doc.page_content, min_length, self.dfs_splitter)
+                yield doc, self.finish_document(doc, result), True
+            return
+
+        max_in_flight = max(self.config.index_preprocessor_processes, 1) * 2
+        pending = collections.deque()
+        for doc, document_chunks in documents:
+            if document_chunks is not None:
+                pending.append((doc, document_chunks, None))
+            else:
+                self.prepare_document(doc)
+                future = executor.submit(
+                    preprocess_text_in_worker,
+                    doc.page_content,
+                    min_length,
+                    self.config.index_text_splitter_goal_length,
+                    self.config.index_text_splitter_overlap_percent,
+                    self.config.index_text_splitter_segmenter,
+                )
+                pending.append((doc, None, future))
+            while pending and (
+                len(pending) > max_in_flight
+                or pending[0][2] is None
+                or pending[0][2].done()
+            ):
+                yield self.next_processed_document(pending)
+        while pending:
+            yield self.next_processed_document(pending)
+
+    def next_processed_document(self, pending):
+        doc, document_chunks, future = pending.popleft()
+        if future is None:
+            return doc, document_chunks, False
+        return doc, self.finish_document(doc, future.result()), True
+
+    def prepare_document(self, doc):
+        # If no doc title use the url and the resource type
+        if not doc.metadata.get("title"):
+            parsed_url = urlparse(doc.metadata.get("loc"))
+            _, tail = os.path.split(parsed_url.path)
+            # Strip anything with "." like ".html"
+            root, _ = os.path.splitext(tail)
+            doc.metadata["title"] = f"{self.data_source_config.data_source_name}: {root}"
+
+        doc.metadata["title"] = TextProcessing.strip_excess_whitespace(
+            doc.metadata["title"]
+        )
+
+    def finish_document(self, doc, result):
+        # result is from preprocess_text, possibly run in a worker process
+        doc.page_content, content_length, text_chunks = result
+
+        self.print_and_log(f"Processing: {doc.metadata['title']}")
+
+        if content_length < self.config.index_preprocessor_min_length:
+            self.print_and_log(
+                f"🔴 Skipping doc because content length: {content_length} is shorter than minimum: { self.data_source_config.config.index_preprocessor_min_length}"
+            )
+            return []
+        return self.create_document_chunks(doc, text_chunks)
+
+    def create_document_chunks(self, doc, text_chunks):
+        if text_chunks is None:
+            self.print_and_log("🔴 Something went wrong with the text splitter.")
+            return []
+        # If it's not a list, wrap it inside a list
+        if not isinstance(text_chunks, list):
+            text_chunks = [text_chunks]
+
+        token_counts = [self.tiktoken_len(chunk) for chunk in text_chunks]
+        self.print_and_log(
+            f"🟢 Doc split into {len(text_chunks)} of averge length {int(sum(token_counts) / len(text_chunks))}"
+        )
+
+        document_chunks = []
+        for text_chunk in text_chunks:
+            document_chunk, _ = self.append_metadata(text_chunk, doc)
+            document_chunks.append(document_chunk)
+        return document_chunks
+
     def append_metadata(self, text_chunk, page):
         # Document chunks are the metadata uploaded to vectorstore
         document_chunk = {
@@ -633,44 +894,6 @@ class CEQTextPreProcessor:
 
         return document_chunk, text_chunk
 
-    def compare_chunks(self, data_source, document_chunks):
-        folder_path = f"{self.index_agent.index_dir}/outputs/{data_source.data_domain_name}/{data_source.data_source_name}"
-        # Create the directory if it does not exist
-        os.makedirs(folder_path, exist_ok=True)
-        existing_files = os.listdir(folder_path)
-        has_changes = False
-        # This will keep track of the counts for each title
-        title_counter = {}
-        # This will hold the titles of new or different chunks
-        new_or_changed_chunks = []
-        for document_chunk in document_chunks:
-            sanitized_title = re.sub(r"\W+", "_", document_chunk["title"])
-            text_chunk = f"{document_chunk['content']} title: {document_chunk['title']}"
-            # Skip overly long chunks
-            # if (
-            #     self.tiktoken_len(text_chunk)
-            #     > self.config.index_text_splitter_max_length
-            # ):
-            #     continue
-            # Check if we've seen this title before, if not initialize to 0
-            if sanitized_title not in title_counter:
-                title_counter[sanitized_title] = 0
-            file_name = f"{sanitized_title}_{title_counter[sanitized_title]}.json"
-            # Increment the counter for this title
-            title_counter[sanitized_title] += 1
-            if file_name not in existing_files:
-                has_changes = True
-                new_or_changed_chunks.append(document_chunk["title"])
-            else:
-                existing_file_path = os.path.join(folder_path, file_name)
-                with open(existing_file_path, "r") as f:
-                    existing_data = json.load(f)
-                    if existing_data != document_chunk:
-                        has_changes = True
-                        new_or_changed_chunks.append(document_chunk["title"])
-
-        return has_changes, new_or_changed_chunks
-
     def create_text_chunks(self, data_source, document_chunks):
         checked_document_chunks = []
         checked_text_chunks = []
@@ -696,27 +919,19 @@ class CEQTextPreProcessor:
         return checked_text_chunks, checked_document_chunks
 
     def write_chunks(self, data_source, document_chunks):
-        folder_path = f"{self.index_agent.index_dir}/outputs/{data_source.data_domain_name}/{data_source.data_source_name}"
-        # Clear the folder first
-        shutil.rmtree(folder_path)
-        os.makedirs(folder_path, exist_ok=True)
-        # This will keep track of the counts for each title
-        title_counter = {}
+        chunks = []
         for document_chunk in document_chunks:
-            sanitized_title = re.sub(r"\W+", "_", document_chunk["title"])
-            text_chunk = f"{document_chunk['content']} title: {document_chunk['title']}"
-            # Skip overly long chunks
-            # if (
-            #     self.tiktoken_len(text_chunk)
-            #     > self.config.index_text_splitter_max_length
-            # ):
-            #     continue
-            # Check if we've seen this title before, if not initialize to 0
-            if sanitized_title not in title_counter:
-                title_counter[sanitized_title] = 0
-            file_name = f"{sanitized_title}_{title_counter[sanitized_title]}.json"
-            # Increment the counter for this title
-            title_counter[sanitized_title] += 1
-            file_path = os.path.join(folder_path, file_name)
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(document_chunk, f, indent=4)
+            text_chunk = (
+                f"{document_chunk['content']} title: {document_chunk['title']}".lower()
+            )
+            chunk_id, _ = ChunkManifest.create_entry(
+                data_source.data_source_name, text_chunk, document_chunk
+            )
+            chunks.append((chunk_id, document_chunk))
+        ChunkStore(data_source.chunk_store_path).write(chunks)
+
+        # Remove the one file per chunk layout the store replaces
+        folder_path = os.path.dirname(data_source.chunk_store_path)
+        for file_name in os.listdir(folder_path):
+            if file_name.endswith(".json"):
+                os.remove(os.path.join(folder_path, file_name))
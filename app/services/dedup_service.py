@@ -0,0 +1,71 @@
+import re
+import zlib
+import numpy as np
+
+
+class MinHashDeduplicator:
+    """Finds near-duplicate texts with MinHash signatures over word shingles and LSH banding.
+    Texts whose estimated Jaccard similarity reaches the threshold are duplicates of the first one added.
+    """
+
+    # Smallest prime above 2**32, so (a * x + b) fits in uint64 for 32 bit shingle hashes
+    _prime = np.uint64(4294967311)
+
+    def __init__(self, threshold=0.85, num_perm=64, bands=16, shingle_size=3, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2**32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2**32, size=num_perm, dtype=np.uint64)
+        # One dict per band from the band's rows to the keys that share them
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def shingle_hashes(self, text):
+        words = re.findall(r"\w+", text.lower())
+        if len(words) <= self.shingle_size:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {
+                " ".join(words[i : i + self.shingle_size])
+                for i in range(len(words) - self.shingle_size + 1)
+            }
+        return np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+
+    def signature(self, text):
+        hashes = self.shingle_hashes(text)
+        # Each row of the product is one hash permutation applied to every shingle
+        permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % self._prime
+        return permuted.min(axis=1)
+
+    def find_or_add(self, key, text):
+        """Returns the key of an earlier near-duplicate of text, or adds text under key and returns None."""
+        signature = self.signature(text)
+        band_keys = [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+        candidates = []
+        for band, band_key in enumerate(band_keys):
+            for candidate in self.buckets[band].get(band_key, ()):
+                if candidate not in candidates:
+                    candidates.append(candidate)
+        for candidate in candidates:
+            # The fraction of matching minhashes estimates the Jaccard similarity
+            similarity = np.mean(self.signatures[candidate] == signature)
+            if similarity >= self.threshold:
+                return candidate
+
+        self.signatures[key] = signature
+        for band, band_key in enumerate(band_keys):
+            self.buckets[band].setdefault(band_key, []).append(key)
+        return None
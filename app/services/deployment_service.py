@@ -19,7 +19,7 @@ class SingletonMeta(type):
 
 
 class DeploymentInstance(metaclass=SingletonMeta):
-    def __init__(self, config, run_index_management=None):
+    def __init__(self, config, run_index_management=None, dry_run=False):
         ### Deployment
         self.config = config
         self.deployment_name = config.DeploymentConfig.deployment_name
@@ -40,7 +40,7 @@ class DeploymentInstance(metaclass=SingletonMeta):
                     )
 
         if run_index_management:
-            self.index_agent = self.load_index_agent()
+            self.index_agent = self.load_index_agent(dry_run)
         else:
             with concurrent.futures.ThreadPoolExecutor() as executor:
                 for SpriteClass in self.used_sprites:
@@ -61,14 +61,30 @@ class DeploymentInstance(metaclass=SingletonMeta):
 
         self.index_name: str = self.index_description_file["index_name"]
         self.index_env: str = self.index_description_file["index_env"]
+        # "deployment" keeps everything in one namespace and filters by metadata
+        # "partitioned" writes each data_domain and doc_type to its own namespace
+        self.index_namespace_layout: str = self.index_description_file.get(
+            "index_namespace_layout", "deployment"
+        )
+        if self.index_namespace_layout not in ["deployment", "partitioned"]:
+            raise ValueError(
+                f"Invalid index_namespace_layout: {self.index_namespace_layout}"
+            )
+
+    def get_index_namespace(self, data_domain_name=None, doc_type=None):
+        match self.index_namespace_layout:
+            case "partitioned":
+                return f"{self.deployment_name}_{data_domain_name}_{doc_type}"
+            case _:
+                return self.deployment_name
 
-    def load_index_agent(self):
+    def load_index_agent(self, dry_run=False):
         self.index_config = IndexModel()
         for secret in self.index_config.SECRETS_:
             self.secrets[secret] = os.environ.get(
                 f"{self.deployment_name.upper()}_{secret.upper()}"
             )
-        return IndexService(self)
+        return IndexService(self, dry_run)
 
 
 class MonikerInstance:
@@ -0,0 +1,122 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from services.embedding_storage_service import EmbeddingCodec
+
+
+class EmbeddingCache:
+    """Persistent cache of embeddings keyed by (embedding model, sha256 of the exact embedded text).
+    Embeddings are stored as EmbeddingCodec blobs in a single SQLite file so any service can share it.
+    """
+
+    # SQLite limits the number of variables in a single statement
+    _lookup_batch_size = 500
+    # Reads go through memory mapped pages instead of a read call per page
+    _mmap_size = 256 * 1024 * 1024
+
+    def __init__(self, cache_path, storage_format="float32"):
+        self.cache_path = cache_path
+        self.codec = EmbeddingCodec(storage_format)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(f"PRAGMA mmap_size={self._mmap_size}")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    storage_format TEXT NOT NULL DEFAULT 'float32',
+                    PRIMARY KEY (model, text_hash)
+                ) WITHOUT ROWID"""
+            )
+            # Caches created before storage formats only hold float32
+            columns = [
+                row[1]
+                for row in self.connection.execute("PRAGMA table_info(embeddings)")
+            ]
+            if "storage_format" not in columns:
+                self.connection.execute(
+                    "ALTER TABLE embeddings ADD COLUMN storage_format TEXT NOT NULL DEFAULT 'float32'"
+                )
+            self.connection.commit()
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model, text_hashes):
+        """Returns {text_hash: float32 array} for the hashes found in the cache."""
+        found = {}
+        with self.lock:
+            for start in range(0, len(text_hashes), self._lookup_batch_size):
+                batch = text_hashes[start : start + self._lookup_batch_size]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT text_hash, embedding, storage_format FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for text_hash, embedding, storage_format in rows:
+                    found[text_hash] = EmbeddingCodec.decode(storage_format, embedding)
+        return found
+
+    def put_many(self, model, text_hashes, embeddings):
+        rows = [
+            (model, text_hash, self.codec.encode(embedding), self.codec.storage_format)
+            for text_hash, embedding in zip(text_hashes, embeddings)
+        ]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, embedding, storage_format) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.commit()
+
+
+class CachedEmbeddings:
+    """Wraps an embeddings client with the same embed_documents/embed_query interface.
+    Texts found in the EmbeddingCache skip the API entirely.
+    """
+
+    def __init__(self, embedding_retriever, embedding_cache, model, print_and_log=None):
+        self.embedding_retriever = embedding_retriever
+        self.embedding_cache = embedding_cache
+        self.model = model
+        self.print_and_log = print_and_log
+
+    def embed_documents(self, texts):
+        text_hashes = [EmbeddingCache.text_hash(text) for text in texts]
+        cached = self.embedding_cache.get_many(self.model, list(set(text_hashes)))
+
+        # Texts repeated within the request are only embedded once
+        missing = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+
+        if self.print_and_log:
+            self.print_and_log(
+                f"Embedding cache hits: {len(texts) - len(missing)} misses: {len(missing)}"
+            )
+
+        if missing:
+            missing_hashes = list(missing.keys())
+            new_embeddings = self.embedding_retriever.embed_documents(
+                list(missing.values())
+            )
+            self.embedding_cache.put_many(self.model, missing_hashes, new_embeddings)
+            for text_hash, embedding in zip(missing_hashes, new_embeddings):
+                cached[text_hash] = np.asarray(embedding, dtype=np.float32)
+
+        if not text_hashes:
+            return []
+        # One contiguous float32 matrix rather than a list of Python floats per text
+        return np.stack([cached[text_hash] for text_hash in text_hashes])
+
+    def embed_query(self, text):
+        # Queries go straight to the vectorstore API, which takes a list
+        return self.embed_documents([text])[0].tolist()
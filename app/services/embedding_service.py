@@ -0,0 +1,267 @@
+import time
+import random
+import threading
+import concurrent.futures
+import openai
+import tiktoken
+import numpy as np
+from services.pinecone_io_pinecone_text.dense.sentence_transformer_encoder import (
+    SentenceTransformerEncoder,
+)
+
+
+class TokenBucket:
+    """Thread safe token bucket refilled continuously at per_minute / 60 per second."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.refill_rate = per_minute / 60
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount):
+        # Requests larger than the bucket would wait forever so they only wait for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.refill_rate,
+                )
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) / self.refill_rate
+            time.sleep(wait_seconds)
+
+
+class EmbeddingScheduler:
+    """Embeds texts with the OpenAI embeddings endpoint.
+    Texts are packed into batches by token count and the batches are sent concurrently
+    under requests-per-minute and tokens-per-minute limits.
+    Concurrency is halved on a 429 and grows back by one after a run of successful requests.
+    Has the same embed_documents/embed_query interface as langchain's OpenAIEmbeddings.
+    """
+
+    _retryable_errors = (
+        openai.error.Timeout,
+        openai.error.APIError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+    )
+
+    def __init__(
+        self,
+        model,
+        api_key,
+        tiktoken_encoding_model,
+        max_chunk_tokens=8191,
+        max_batch_size=100,
+        max_batch_tokens=50000,
+        requests_per_minute=3000,
+        tokens_per_minute=1000000,
+        max_concurrency=4,
+        request_timeout=180.0,
+        max_retries=6,
+        print_and_log=None,
+    ):
+        self.model = model
+        self.api_key = api_key
+        self.tokenizer = tiktoken.encoding_for_model(tiktoken_encoding_model)
+        self.max_chunk_tokens = max_chunk_tokens
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.print_and_log = print_and_log
+
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency_limit = self.max_concurrency
+        self.in_flight = 0
+        self.successes_since_change = 0
+        self.concurrency_condition = threading.Condition()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrency
+        )
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        batches = self.create_batches(texts)
+        futures = [
+            self.executor.submit(self.embed_batch, batch_texts, batch_tokens)
+            for batch_texts, batch_tokens in batches
+        ]
+        # Futures are read in submission order so results line up with texts.
+        # Stored as one float32 matrix rather than lists of Python floats
+        embeddings = np.concatenate(
+            [np.asarray(future.result(), dtype=np.float32) for future in futures]
+        )
+
+        if self.print_and_log:
+            self.print_and_log(
+                f"Embedded {len(texts)} texts in {len(batches)} requests ({sum(tokens for _, tokens in batches)} tokens, concurrency limit {self.concurrency_limit})"
+            )
+        return embeddings
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0].tolist()
+
+    def close(self):
+        # The request threads are reused by the next ingest
+        pass
+
+    def create_batches(self, texts):
+        """Greedily packs texts in order into (texts, token_count) batches."""
+        batches = []
+        batch_texts = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = self.tokenizer.encode(text, disallowed_special=())
+            if len(tokens) > self.max_chunk_tokens:
+                tokens = tokens[: self.max_chunk_tokens]
+                text = self.tokenizer.decode(tokens)
+            if batch_texts and (
+                len(batch_texts) >= self.max_batch_size
+                or batch_tokens + len(tokens) > self.max_batch_tokens
+            ):
+                batches.append((batch_texts, batch_tokens))
+                batch_texts = []
+                batch_tokens = 0
+            batch_texts.append(text)
+            batch_tokens += len(tokens)
+        if batch_texts:
+            batches.append((batch_texts, batch_tokens))
+        return batches
+
+    def embed_batch(self, batch_texts, batch_tokens):
+        for attempt in range(self.max_retries + 1):
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(batch_tokens)
+            self.acquire_slot()
+            rate_limited = False
+            retry_after = None
+            try:
+                response = openai.Embedding.create(
+                    input=batch_texts,
+                    model=self.model,
+                    api_key=self.api_key,
+                    request_timeout=self.request_timeout,
+                )
+                data = sorted(response["data"], key=lambda item: item["index"])
+                return [item["embedding"] for item in data]
+            except openai.error.RateLimitError as error:
+                rate_limited = True
+                last_error = error
+                headers = getattr(error, "headers", None) or {}
+                retry_after = headers.get("retry-after")
+            except self._retryable_errors as error:
+                last_error = error
+            finally:
+                self.release_slot(rate_limited)
+
+            if attempt == self.max_retries:
+                raise last_error
+            if retry_after is not None:
+                wait_seconds = float(retry_after)
+            else:
+                # Exponential backoff with jitter so concurrent batches don't retry in lockstep
+                wait_seconds = min(60, 2**attempt) * (0.5 + random.random() / 2)
+            if self.print_and_log:
+                self.print_and_log(
+                    f"Embedding request failed ({type(last_error).__name__}), retrying in {wait_seconds:.1f}s"
+                )
+            time.sleep(wait_seconds)
+
+    def acquire_slot(self):
+        with self.concurrency_condition:
+            while self.in_flight >= self.concurrency_limit:
+                self.concurrency_condition.wait()
+            self.in_flight += 1
+
+    def release_slot(self, rate_limited):
+        with self.concurrency_condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                self.successes_since_change = 0
+            else:
+                self.successes_since_change += 1
+                if (
+                    self.concurrency_limit < self.max_concurrency
+                    and self.successes_since_change >= self.concurrency_limit
+                ):
+                    self.concurrency_limit += 1
+                    self.successes_since_change = 0
+            self.concurrency_condition.notify_all()
+
+
+class LocalEmbeddings:
+    """Embeds texts on this machine with a sentence-transformers model, without rate limits.
+    Returns float32 arrays. Has the same embed_documents/embed_query interface as EmbeddingScheduler.
+    """
+
+    def __init__(self, model, batch_size=32, processes=0, print_and_log=None):
+        self.model = model
+        self.encoder = SentenceTransformerEncoder(
+            model, device="cpu", batch_size=batch_size, processes=processes
+        )
+        self.print_and_log = print_and_log
+        # The process pool's queues can't be shared by concurrent calls
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        start_time = time.time()
+        with self.lock:
+            embeddings = self.encoder.encode_documents(texts)
+        if self.print_and_log:
+            self.print_and_log(
+                f"Embedded {len(texts)} texts locally in {time.time() - start_time:.1f}s"
+            )
+        return embeddings
+
+    def embed_query(self, text):
+        # Queries go straight to the vectorstore API, which takes a list
+        return self.encoder.encode_queries(text).tolist()
+
+    def close(self):
+        with self.lock:
+            self.encoder.close()
+
+
+def create_embedding_retriever(index_config, api_key, print_and_log=None):
+    """Returns the embedding backend selected by index_config.index_embedding_backend."""
+    match index_config.index_embedding_backend:
+        case "local":
+            return LocalEmbeddings(
+                index_config.index_embedding_local_model,
+                batch_size=index_config.index_embedding_local_batch_size,
+                processes=index_config.index_embedding_local_processes,
+                print_and_log=print_and_log,
+            )
+        case "openai":
+            return EmbeddingScheduler(
+                model=index_config.index_embedding_model,
+                api_key=api_key,
+                tiktoken_encoding_model=index_config.index_tiktoken_encoding_model,
+                max_chunk_tokens=index_config.index_embedding_max_chunk_size,
+                max_batch_size=index_config.index_embedding_batch_size,
+                max_batch_tokens=index_config.index_embedding_batch_max_tokens,
+                requests_per_minute=index_config.index_embedding_requests_per_minute,
+                tokens_per_minute=index_config.index_embedding_tokens_per_minute,
+                max_concurrency=index_config.index_embedding_max_concurrency,
+                request_timeout=index_config.index_openai_timeout_seconds,
+                print_and_log=print_and_log,
+            )
+        case _:
+            raise ValueError(
+                f"Invalid index_embedding_backend: {index_config.index_embedding_backend}"
+            )
@@ -0,0 +1,96 @@
+import lxml.html
+from lxml import etree
+
+# Never part of the page text
+_skipped_tags = {"script", "style", "template", "noscript"}
+
+
+def parse_html(html_text):
+    # lxml builds the tree in C, which is where bs4's html.parser spends most of its time
+    try:
+        return lxml.html.document_fromstring(html_text)
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def element_text(element, separator="", is_removed=None):
+    """Same text as bs4's get_text(separator) without mutating the tree.
+    Elements matching is_removed are skipped as if decomposed, but their tail text is kept.
+    """
+    parts = []
+
+    def walk(node):
+        if node.text:
+            parts.append(node.text)
+        for child in node:
+            if (
+                isinstance(child.tag, str)
+                and child.tag not in _skipped_tags
+                and not (is_removed and is_removed(child))
+            ):
+                walk(child)
+            if child.tail:
+                parts.append(child.tail)
+
+    walk(element)
+    return separator.join(parts)
+
+
+def find_by_id(tree, element_id):
+    matches = tree.xpath("//*[@id=$element_id]", element_id=element_id)
+    return matches[0] if matches else None
+
+
+def page_title(tree):
+    title = tree.find(".//title")
+    return element_text(title) if title is not None else ""
+
+
+def is_hidden_or_toc(element):
+    # Matches the '[style*="visibility: hidden"], [class*="toc"]' selector and header tags
+    return (
+        element.tag == "header"
+        or "visibility: hidden" in element.get("style", "")
+        or "toc" in element.get("class", "")
+    )
+
+
+def extract_sitemap_page(html_text):
+    """Returns (title, text) from the content-container or content element.
+    The title is left empty, as SitemapLoader left it, so the preprocessor titles the page from its url.
+    Using the page <title> would change every sitemap chunk's text and id and re-embed the whole source.
+    """
+    tree = parse_html(html_text)
+    if tree is None:
+        return "", ""
+    content_element = find_by_id(tree, "content-container")
+    if content_element is None:
+        content_element = find_by_id(tree, "content")
+    if content_element is None:
+        return "", ""
+    return "", element_text(
+        content_element, separator=" ", is_removed=is_hidden_or_toc
+    )
+
+
+def extract_gitbook_page(html_text):
+    """Returns (title, text) from the page's main element, titled by its first h1."""
+    tree = parse_html(html_text)
+    if tree is None:
+        return "", ""
+    content = tree.find(".//main")
+    if content is None:
+        return "", ""
+    title_element = content.find(".//h1")
+    title = element_text(title_element) if title_element is not None else ""
+    return title, element_text(content, separator="\n").strip()
+
+
+def extract_generic_page(html_text):
+    """Returns (title, text) from the element with id content."""
+    tree = parse_html(html_text)
+    if tree is None:
+        return "", ""
+    text_element = find_by_id(tree, "content")
+    text = element_text(text_element) if text_element is not None else ""
+    return page_title(tree), text
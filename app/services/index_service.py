@@ -1,18 +1,37 @@
-import os, traceback
+import os, traceback, time
+import concurrent.futures
 from typing import Iterator
 import yaml, json
 import pinecone
 from services.log_service import Logger
 from services.open_api_minifier_service import OpenAPIMinifierService
-from services.data_processing_service import CEQTextPreProcessor
+from services.data_processing_service import (
+    CEQTextPreProcessor,
+    TextProcessing,
+    init_preprocessor_worker,
+)
+from services.embedding_cache_service import EmbeddingCache, CachedEmbeddings
+from services.embedding_service import create_embedding_retriever
+from services.vectorstore_service import VectorUpserter
+from services.chunk_manifest_service import ChunkManifest
+from services.chunk_store_service import ChunkStore
+from services.crawler_service import HttpCache, WebCrawler
+from services.html_extraction_service import (
+    extract_sitemap_page,
+    extract_gitbook_page,
+    extract_generic_page,
+)
+from services.pipeline_service import BoundedPipeline
+from services.checkpoint_service import IngestCheckpoint
+from services.dedup_service import MinHashDeduplicator
 from langchain.schema import Document
-from langchain.document_loaders import GitbookLoader, SitemapLoader, RecursiveUrlLoader
-from langchain.embeddings import OpenAIEmbeddings
-from bs4 import BeautifulSoup
 
 
 class IndexService:
-    def __init__(self, deployment_instance):
+    def __init__(self, deployment_instance, dry_run=False):
+        self.deployment_instance = deployment_instance
+        # Dry runs only plan, so they never touch Pinecone or load the embedding backend
+        self.dry_run = dry_run
         self.deployment_name = deployment_instance.deployment_name
         self.secrets = deployment_instance.secrets
         self.config = deployment_instance.index_config
@@ -25,6 +44,7 @@ class IndexService:
 
         self.index_env = deployment_instance.index_env
         self.index_name = deployment_instance.index_name
+        self.index_namespace_layout = deployment_instance.index_namespace_layout
 
         self.prompt_template_path = "app/prompt_templates"
         self.index_dir = f"app/deployments/{self.deployment_name}/index"
@@ -41,18 +61,45 @@ class IndexService:
                 "Index name in index_description.yaml does not match index from deployment.env!"
             )
 
-        pinecone.init(
-            environment=self.index_env,
-            api_key=self.secrets["pinecone_api_key"],
-        )
+        self.vectorstore = None
+        self.embedding_cache = None
+        self.embedding_retriever = None
+        self.vector_upserter = None
+        self.http_cache = HttpCache(self.config.index_crawler_cache_path)
+
+        if not self.dry_run:
+            pinecone.init(
+                environment=self.index_env,
+                api_key=self.secrets["pinecone_api_key"],
+            )
 
-        indexes = pinecone.list_indexes()
-        if self.index_name not in indexes:
-            # create new index
-            self.create_index()
             indexes = pinecone.list_indexes()
-            self.log.print_and_log(f"Created index: {indexes}")
-        self.vectorstore = pinecone.Index(self.index_name)
+            if self.index_name not in indexes:
+                # create new index
+                self.create_index()
+                indexes = pinecone.list_indexes()
+                self.log.print_and_log(f"Created index: {indexes}")
+            self.vectorstore = pinecone.Index(self.index_name)
+
+            if self.config.index_embedding_cache_enabled:
+                self.embedding_cache = EmbeddingCache(
+                    self.config.index_embedding_cache_path,
+                    self.config.index_embedding_cache_format,
+                )
+
+            # Shared by all data sources so parallel ingest stays under the API rate limits
+            self.embedding_retriever = create_embedding_retriever(
+                self.config, self.secrets["openai_api_key"], self.log.print_and_log
+            )
+            # Shared so concurrent upserts are capped across data sources ingesting in parallel
+            self.vector_upserter = VectorUpserter(
+                self.vectorstore,
+                max_batch_size=self.config.index_vectorstore_upsert_batch_size,
+                max_batch_bytes=self.config.index_vectorstore_upsert_max_bytes,
+                max_concurrency=self.config.index_vectorstore_max_concurrency,
+                value_decimals=self.config.index_vectorstore_value_decimals,
+                print_and_log=self.log.print_and_log,
+            )
 
         ### Adds sources from yaml config file to queue ###
 
@@ -70,161 +117,622 @@ class IndexService:
                 self.enabled_data_sources.append(data_source)
                 self.log.print_and_log(f"Will index: {data_source_name}")
 
-    def ingest_docs(self):
+    def ingest_docs(self, resume=False):
+        if self.dry_run:
+            raise ValueError("Index agent was created for a dry run. Use plan_ingest instead.")
         self.log.print_and_log(
             f"Initial index stats: {self.vectorstore.describe_index_stats()}\n"
         )
 
-        for data_source in self.enabled_data_sources:
-            # Retries if there is an error
-            retry_count = 2
-            for i in range(retry_count):
-                try:
-                    self.log.print_and_log(
-                        f"-----Now indexing: {data_source.data_source_name}\n"
-                    )
-                    # Get count of vectors in index matching the "resource" metadata field
-                    index_resource_stats = data_source.vectorstore.describe_index_stats(
-                        filter={
-                            "data_source_name": {"$eq": data_source.data_source_name}
-                        }
-                    )
-                    existing_resource_vector_count = (
-                        index_resource_stats.get("namespaces", {})
-                        .get(self.deployment_name, {})
-                        .get("vector_count", 0)
-                    )
-                    self.log.print_and_log(
-                        f"Existing vector count for {data_source.data_source_name}: {existing_resource_vector_count}"
-                    )
-
-                    # Load documents
-                    documents = data_source.scraper.load()
-                    if not documents:
+        preprocessor_executor = self.create_preprocessor_executor()
+
+        ingest_results = {}
+        try:
+            if self.config.index_ingest_max_workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config.index_ingest_max_workers
+                ) as executor:
+                    futures = {
+                        executor.submit(
+                            self.ingest_data_source,
+                            data_source,
+                            preprocessor_executor,
+                            resume,
+                        ): data_source
+                        for data_source in self.enabled_data_sources
+                    }
+                    for future in concurrent.futures.as_completed(futures):
+                        data_source = futures[future]
+                        try:
+                            ingest_results[data_source.data_source_name] = future.result()
+                        except Exception as error:
+                            ingest_results[
+                                data_source.data_source_name
+                            ] = f"failed: {error}"
                         self.log.print_and_log(
-                            f"Skipping data_source: no data loaded for {data_source.data_source_name}"
+                            f"{data_source.data_source_name}: {ingest_results[data_source.data_source_name]}"
                         )
-                        break
-                    self.log.print_and_log(
-                        f"Total documents loaded for indexing: {len(documents)}"
-                    )
-
-                    # Removes bad chars, and chunks text
-                    document_chunks = data_source.preprocessor.run(documents)
-                    if not document_chunks:
-                        self.log.print_and_log(
-                            f"Skipping data_source: no data after preprocessing {data_source.data_source_name}"
+            else:
+                for data_source in self.enabled_data_sources:
+                    try:
+                        ingest_results[
+                            data_source.data_source_name
+                        ] = self.ingest_data_source(
+                            data_source, preprocessor_executor, resume
                         )
-                        break
-                    self.log.print_and_log(
-                        f"Total document chunks after processing: {len(document_chunks)}"
-                    )
+                    except Exception as error:
+                        ingest_results[data_source.data_source_name] = f"failed: {error}"
+        finally:
+            if preprocessor_executor is not None:
+                preprocessor_executor.shutdown()
+            self.embedding_retriever.close()
+
+        summary = "\n".join(
+            f" - {data_source_name}: {result}"
+            for data_source_name, result in ingest_results.items()
+        )
+        self.log.print_and_log(f"Ingest results:\n{summary}")
+        self.log.print_and_log(
+            f"Final index stats: {self.vectorstore.describe_index_stats()}"
+        )
 
-                    # Checks against local docs if there are changes or new docs
-                    (
-                        has_changes,
-                        new_or_changed_chunks,
-                    ) = data_source.preprocessor.compare_chunks(
-                        data_source, document_chunks
-                    )
-                    # If there are changes or new docs, delete existing local files and write new files
-                    if not has_changes:
-                        self.log.print_and_log(
-                            f"Skipping data_source: no new data found for {data_source.data_source_name}"
-                        )
-                        break
-                    self.log.print_and_log(
-                        f"Found {len(new_or_changed_chunks)} new or changed documents"
-                    )
-                    (
-                        text_chunks,
-                        document_chunks,
-                    ) = data_source.preprocessor.create_text_chunks(
-                        data_source, document_chunks
-                    )
-                    self.log.print_and_log(
-                        f"Total document chunks after final check: {len(document_chunks)}"
-                    )
+        failed_sources = [
+            data_source_name
+            for data_source_name, result in ingest_results.items()
+            if result.startswith("failed")
+        ]
+        if failed_sources:
+            raise RuntimeError(f"Ingest failed for data sources: {failed_sources}")
+
+    def create_preprocessor_executor(self):
+        # Process pool for CPU bound html extraction and text splitting shared by all data sources
+        if self.config.index_preprocessor_processes > 0:
+            # Workers load tiktoken and spaCy once at startup instead of per document
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.config.index_preprocessor_processes,
+                initializer=init_preprocessor_worker,
+                initargs=(
+                    self.config.index_text_splitter_goal_length,
+                    self.config.index_text_splitter_overlap_percent,
+                    self.config.index_text_splitter_segmenter,
+                ),
+            )
+        return None
+
+    def plan_ingest(self):
+        """Dry run of ingest_docs. Loads, splits and diffs each data source against its manifest
+        without calling the embedding or vectorstore APIs, and logs what an ingest would do.
+        """
+        preprocessor_executor = self.create_preprocessor_executor()
+        plans = []
+        try:
+            for data_source in self.enabled_data_sources:
+                plans.append(self.plan_data_source(data_source, preprocessor_executor))
+        finally:
+            if preprocessor_executor is not None:
+                preprocessor_executor.shutdown()
+
+        summary = "\n".join(
+            f" - {plan['data_source_name']}: {plan['documents']} documents, {plan['chunks']} chunks ({plan['duplicate_chunks']} duplicates collapsed), "
+            f"{plan['new_chunks']} new, {plan['changed_metadata_chunks']} metadata changed, {plan['removed_chunks']} removed, "
+            f"{plan['embedding_tokens']} tokens, ${plan['estimated_cost']:.4f}, ~{plan['estimated_seconds']:.0f}s"
+            for plan in plans
+        )
+        total_tokens = sum(plan["embedding_tokens"] for plan in plans)
+        total_cost = sum(plan["estimated_cost"] for plan in plans)
+        total_seconds = sum(plan["estimated_seconds"] for plan in plans)
+        if self.config.index_ingest_max_workers > 1:
+            # Sources run in parallel but share the embedding rate limits
+            total_seconds = max(
+                total_seconds / self.config.index_ingest_max_workers,
+                max((plan["estimated_seconds"] for plan in plans), default=0),
+            )
+        self.log.print_and_log(
+            f"Dry run plan:\n{summary}\nTotal: {total_tokens} tokens, ${total_cost:.4f}, ~{total_seconds:.0f}s"
+        )
+        return plans
 
-                    # Get dense_embeddings
-                    dense_embeddings = data_source.embedding_retriever.embed_documents(
-                        text_chunks
-                    )
+    def plan_data_source(self, data_source, preprocessor_executor=None):
+        data_source.print_and_log(
+            f"-----Now planning: {data_source.data_source_name}\n"
+        )
+        manifest = ChunkManifest(data_source.manifest_path)
+        previous_chunks = manifest.load() or {}
+        data_source.stored_chunks_by_url = data_source.load_stored_chunks_by_url()
+        data_source.process_executor = preprocessor_executor
+        # Nothing is recorded, and the crawl cache is left uncommitted
+        data_source.checkpoint = IngestCheckpoint(None)
+        data_source.resume = False
+
+        run_state = {
+            "document_count": 0,
+            "not_modified_count": 0,
+            "resumed_upserted_count": 0,
+            "document_chunks": [],
+            "current_chunks": {},
+            "changed_metadata_chunks": {},
+            "duplicate_count": 0,
+            "duplicate_urls": {},
+            "superseded_ids": set(),
+        }
+        start_time = time.time()
+        new_chunk_count = 0
+        embedding_tokens = 0
+        for batch in self.iter_new_chunk_batches(
+            data_source, previous_chunks, run_state, preprocessor_executor
+        ):
+            new_chunk_count += len(batch)
+            embedding_tokens += sum(
+                run_state["current_chunks"][chunk["id"]]["token_count"]
+                for chunk in batch
+            )
+        load_seconds = time.time() - start_time
+        self.merge_duplicate_urls(data_source, previous_chunks, run_state)
+        _, changed_metadata_ids, removed_ids = manifest.diff(run_state["current_chunks"])
+
+        # The last ingest's throughput includes loading. Without one, loading plus the embedding rate limits
+        is_local = self.config.index_embedding_backend == "local"
+        if manifest.vectors_per_second:
+            estimated_seconds = new_chunk_count / manifest.vectors_per_second
+        elif is_local:
+            estimated_seconds = load_seconds
+        else:
+            request_count = -(-new_chunk_count // self.config.index_embedding_batch_size)
+            estimated_seconds = load_seconds + 60 * max(
+                embedding_tokens / self.config.index_embedding_tokens_per_minute,
+                request_count / self.config.index_embedding_requests_per_minute,
+            )
+        plan = {
+            "data_source_name": data_source.data_source_name,
+            "documents": run_state["document_count"],
+            "not_modified_documents": run_state["not_modified_count"],
+            "chunks": len(run_state["current_chunks"]),
+            "duplicate_chunks": run_state["duplicate_count"],
+            "new_chunks": new_chunk_count,
+            "changed_metadata_chunks": len(changed_metadata_ids),
+            "removed_chunks": len(removed_ids | run_state["superseded_ids"]),
+            "embedding_tokens": embedding_tokens,
+            "estimated_cost": 0
+            if is_local
+            else embedding_tokens / 1000 * self.config.index_embedding_cost_per_1k_tokens,
+            "load_seconds": load_seconds,
+            "estimated_seconds": estimated_seconds,
+        }
+        data_source.print_and_log(
+            f"Planned {data_source.data_source_name} in {load_seconds:.1f}s: {plan}"
+        )
+        return plan
+
+    def ingest_data_source(self, data_source, preprocessor_executor=None, resume=False):
+        # Retries if there is an error. Retries resume from the checkpoint so a failure costs one batch
+        retry_count = 2
+        for i in range(retry_count):
+            try:
+                result = self.run_data_source_ingest(
+                    data_source, preprocessor_executor, resume=resume or i > 0
+                )
+                data_source.commit_crawl_cache()
+                data_source.checkpoint.clear()
+                return result
+            except Exception as error:
+                error_info = traceback.format_exc()
+                data_source.print_and_log(f"An error occurred: {error}\n{error_info}")
+                if i < retry_count - 1:  # i is zero indexed
+                    continue  # this will start the next iteration of loop thus retrying your code block
+                else:
+                    raise  # if exception in the last retry then raise it.
 
-                    # If the "resource" already has vectors delete the existing vectors before upserting new vectors
-                    # We have to delete all because the difficulty in specifying specific documents in pinecone
-                    if existing_resource_vector_count != 0:
-                        self.clear_data_source(data_source)
-                        index_resource_stats = (
-                            data_source.vectorstore.describe_index_stats(
-                                filter={
-                                    "data_source_name": {
-                                        "$eq": data_source.data_source_name
-                                    }
-                                }
-                            )
-                        )
-                        cleared_resource_vector_count = (
-                            index_resource_stats.get("namespaces", {})
-                            .get(self.deployment_name, {})
-                            .get("vector_count", 0)
-                        )
-                        self.log.print_and_log(
-                            f"Removing pre-existing vectors. New count: {cleared_resource_vector_count} (should be 0)"
-                        )
+    def run_data_source_ingest(
+        self, data_source, preprocessor_executor=None, resume=False
+    ):
+        data_source.print_and_log(
+            f"-----Now indexing: {data_source.data_source_name}\n"
+        )
+        # Get count of vectors in index matching the "resource" metadata field
+        index_resource_stats = data_source.vectorstore.describe_index_stats(
+            filter={"data_source_name": {"$eq": data_source.data_source_name}}
+        )
+        existing_resource_vector_count = (
+            index_resource_stats.get("namespaces", {})
+            .get(data_source.namespace, {})
+            .get("vector_count", 0)
+        )
+        data_source.print_and_log(
+            f"Existing vector count for {data_source.data_source_name}: {existing_resource_vector_count}"
+        )
 
-                    vectors_to_upsert = []
-                    vector_counter = 0
-                    for i, document_chunk in enumerate(document_chunks):
-                        prepared_vector = {
-                            "id": f"id-{data_source.data_source_name}-{vector_counter}",
-                            "values": dense_embeddings[i],
-                            "metadata": document_chunk,
-                        }
-                        vector_counter += 1
-                        vectors_to_upsert.append(prepared_vector)
-
-                    self.log.print_and_log(
-                        f"Upserting {len(vectors_to_upsert)} vectors"
-                    )
-                    # data_source.vectorstore.upsert(
-                    #     vectors=vectors_to_upsert,
-                    #     namespace=self.deployment_name,
-                    #     batch_size=self.config.index_vectorstore_upsert_batch_size,
-                    #     show_progress=True,
-                    # )
-
-                    index_resource_stats = data_source.vectorstore.describe_index_stats(
-                        filter={
-                            "data_source_name": {"$eq": data_source.data_source_name}
-                        }
-                    )
-                    new_resource_vector_count = (
-                        index_resource_stats.get("namespaces", {})
-                        .get(self.deployment_name, {})
-                        .get("vector_count", 0)
+        manifest = ChunkManifest(data_source.manifest_path)
+        previous_chunks = manifest.load()
+        data_source.stored_chunks_by_url = data_source.load_stored_chunks_by_url()
+        data_source.process_executor = preprocessor_executor
+
+        checkpoint = IngestCheckpoint(data_source.checkpoint_path)
+        if resume and checkpoint.load():
+            data_source.print_and_log(
+                f"Resuming from checkpoint: {len(checkpoint.chunks_by_source)} documents chunked, {len(checkpoint.embedded_ids)} chunks embedded, {len(checkpoint.upserted_ids)} chunks upserted"
+            )
+            # Vectors upserted before the interruption must survive the legacy clear check
+            needs_legacy_clear = (
+                checkpoint.needs_legacy_clear and not checkpoint.legacy_cleared
+            )
+        else:
+            checkpoint.clear()
+            # No manifest means existing vectors used positional ids so they're cleared once
+            needs_legacy_clear = (
+                previous_chunks is None and existing_resource_vector_count != 0
+            )
+            checkpoint.record("started", needs_legacy_clear=needs_legacy_clear)
+        data_source.checkpoint = checkpoint
+        data_source.resume = resume
+        if previous_chunks is None:
+            previous_chunks = {}
+
+        # Filled in by the pipeline's source stage as documents are chunked
+        run_state = {
+            "document_count": 0,
+            "not_modified_count": 0,
+            "resumed_upserted_count": 0,
+            "document_chunks": [],
+            "current_chunks": {},
+            "changed_metadata_chunks": {},
+            "duplicate_count": 0,
+            "duplicate_urls": {},
+            "superseded_ids": set(),
+        }
+
+        # Load and split -> embed -> upsert, with bounded queues between stages
+        pipeline = BoundedPipeline(
+            stages=[lambda batch: self.embed_chunk_batch(data_source, batch)],
+            queue_size=self.config.index_ingest_queue_size,
+        )
+        start_time = time.time()
+        upserted_count = 0
+        vectors_per_second = None
+        for vectors_to_upsert in pipeline.run(
+            self.iter_new_chunk_batches(
+                data_source, previous_chunks, run_state, preprocessor_executor
+            )
+        ):
+            if needs_legacy_clear:
+                self.clear_data_source(data_source)
+                checkpoint.record("legacy_cleared")
+                data_source.print_and_log(
+                    f"No ingest manifest found. Cleared {existing_resource_vector_count} pre-existing vectors."
+                )
+                needs_legacy_clear = False
+            upserted_count += self.vector_upserter.upsert(
+                vectors_to_upsert, data_source.namespace
+            )
+            checkpoint.record(
+                "upserted", ids=[vector["id"] for vector in vectors_to_upsert]
+            )
+            data_source.print_and_log(
+                f"Upserted {upserted_count} vectors after {time.time() - start_time:.1f}s"
+            )
+        if upserted_count:
+            elapsed_seconds = max(time.time() - start_time, 1e-6)
+            vectors_per_second = upserted_count / elapsed_seconds
+            data_source.print_and_log(
+                f"Ingest throughput: {vectors_per_second:.0f} vectors/s"
+            )
+
+        # Chunks upserted before resuming still count as new for this run
+        upserted_count += run_state["resumed_upserted_count"]
+        self.merge_duplicate_urls(data_source, previous_chunks, run_state)
+        document_chunks = run_state["document_chunks"]
+        current_chunks = run_state["current_chunks"]
+        changed_metadata_chunks = run_state["changed_metadata_chunks"]
+        if not run_state["document_count"]:
+            data_source.print_and_log(
+                f"Skipping data_source: no data loaded for {data_source.data_source_name}"
+            )
+            return "skipped: no data loaded"
+        if not document_chunks:
+            data_source.print_and_log(
+                f"Skipping data_source: no data after preprocessing {data_source.data_source_name}"
+            )
+            return "skipped: no data after preprocessing"
+
+        new_ids, changed_metadata_ids, removed_ids = manifest.diff(current_chunks)
+        removed_ids = sorted(removed_ids | run_state["superseded_ids"])
+        data_source.print_and_log(
+            f"Documents: {run_state['document_count']} ({run_state['not_modified_count']} not modified), chunks: {len(document_chunks)}"
+        )
+        data_source.print_and_log(
+            f"Chunks new: {upserted_count}, metadata changed: {len(changed_metadata_ids)}, removed: {len(removed_ids)}, unchanged: {len(current_chunks) - len(new_ids) - len(changed_metadata_ids)}"
+        )
+        if not upserted_count and not changed_metadata_chunks and not removed_ids:
+            data_source.print_and_log(
+                f"Skipping data_source: no new data found for {data_source.data_source_name}"
+            )
+            return "skipped: no new data"
+
+        # Same text with new metadata doesn't need a new embedding
+        for chunk_id, document_chunk in changed_metadata_chunks.items():
+            data_source.vectorstore.update(
+                id=chunk_id,
+                set_metadata=document_chunk,
+                namespace=data_source.namespace,
+            )
+        if removed_ids:
+            data_source.print_and_log(f"Deleting {len(removed_ids)} vectors")
+            batch_size = self.config.index_vectorstore_delete_batch_size
+            for start in range(0, len(removed_ids), batch_size):
+                data_source.vectorstore.delete(
+                    ids=removed_ids[start : start + batch_size],
+                    namespace=data_source.namespace,
+                )
+
+        index_resource_stats = data_source.vectorstore.describe_index_stats(
+            filter={"data_source_name": {"$eq": data_source.data_source_name}}
+        )
+        new_resource_vector_count = (
+            index_resource_stats.get("namespaces", {})
+            .get(data_source.namespace, {})
+            .get("vector_count", 0)
+        )
+        data_source.print_and_log(
+            f"Indexing complete for: {data_source.data_source_name}\nPrevious vector count: {existing_resource_vector_count}\nNew vector count: {new_resource_vector_count}\n"
+        )
+        # data_source.print_and_log(f'Post-upsert index stats: {index_resource_stats}\n')
+        # Verified once here rather than after every batch. Stats can lag behind recent writes
+        if new_resource_vector_count != len(current_chunks):
+            data_source.print_and_log(
+                f"Vector count mismatch: expected {len(current_chunks)}, index reports {new_resource_vector_count}"
+            )
+
+        data_source.preprocessor.write_chunks(data_source, document_chunks)
+        manifest.write(current_chunks, vectors_per_second)
+
+        return "indexed"
+
+    def iter_document_chunks(self, data_source, run_state, preprocessor_executor=None):
+        # Yields each document's chunks as soon as it is loaded and split
+        if data_source.content_type != "text":
+            # OpenAPI specs are merged before minifying so they're processed together
+            documents = data_source.scraper.load()
+            if not documents:
+                return
+            run_state["document_count"] = len(documents)
+            document_chunks = data_source.preprocessor.run(
+                documents, preprocessor_executor
+            )
+            if document_chunks:
+                yield document_chunks
+            return
+
+        def iter_documents():
+            for doc in data_source.iter_documents():
+                run_state["document_count"] += 1
+                if doc.metadata.get("not_modified"):
+                    # Unchanged pages reuse last run's chunks without parsing or splitting
+                    run_state["not_modified_count"] += 1
+                    yield doc, data_source.stored_chunks_by_url.get(
+                        doc.metadata["source"], []
                     )
-                    self.log.print_and_log(
-                        f"Indexing complete for: {data_source.data_source_name}\nPrevious vector count: {existing_resource_vector_count}\nNew vector count: {new_resource_vector_count}\n"
+                else:
+                    yield doc, data_source.checkpoint.chunks_by_source.get(
+                        doc.metadata.get("source")
                     )
-                    # self.log.print_and_log(f'Post-upsert index stats: {index_resource_stats}\n')
 
-                    data_source.preprocessor.write_chunks(data_source, document_chunks)
+        # Several documents are split in the process pool at once, but yielded in order
+        for doc, document_chunks, processed in data_source.preprocessor.process_documents(
+            iter_documents(), preprocessor_executor
+        ):
+            doc_source = doc.metadata.get("source")
+            if processed and doc_source:
+                data_source.checkpoint.record(
+                    "chunked", source=doc_source, chunks=document_chunks
+                )
+            if document_chunks:
+                yield document_chunks
 
-                    # If completed successfully, break the retry loop
-                    break
+    def iter_new_chunk_batches(
+        self, data_source, previous_chunks, run_state, preprocessor_executor=None
+    ):
+        """Yields batches of chunks that need embeddings, sized by index_ingest_batch_size.
+        Chunks already in the manifest are only recorded in run_state.
+        """
+        # Keyed by chunk id so a kept chunk that's replaced before its batch is sent can be dropped
+        batch = {}
+        sent_ids = set()
+        upserted_ids = data_source.checkpoint.upserted_ids
+        chunks = self.collapse_duplicate_chunks(
+            data_source,
+            self.iter_source_chunks(data_source, run_state, preprocessor_executor),
+            previous_chunks,
+            run_state,
+        )
+        for chunk, superseded_id in chunks:
+            chunk_id, text_chunk, document_chunk, manifest_entry = chunk
+            if superseded_id is not None:
+                run_state["current_chunks"].pop(superseded_id, None)
+                run_state["changed_metadata_chunks"].pop(superseded_id, None)
+                if batch.pop(superseded_id, None) is None and (
+                    superseded_id in sent_ids or superseded_id in upserted_ids
+                ):
+                    # Already in the index but not in the manifest, so removed_ids won't cover it
+                    run_state["superseded_ids"].add(superseded_id)
+            was_superseded = chunk_id in run_state["superseded_ids"]
+            run_state["superseded_ids"].discard(chunk_id)
+            manifest_entry["token_count"] = TextProcessing.tiktoken_len(text_chunk)
+            run_state["current_chunks"][chunk_id] = manifest_entry
+            if chunk_id in sent_ids or chunk_id in upserted_ids:
+                if was_superseded:
+                    # Kept again, possibly from another url, so only the metadata can have changed
+                    run_state["changed_metadata_chunks"][chunk_id] = document_chunk
+            elif chunk_id not in previous_chunks:
+                batch[chunk_id] = {
+                    "id": chunk_id,
+                    "text_chunk": text_chunk,
+                    "document_chunk": document_chunk,
+                }
+            elif (
+                previous_chunks[chunk_id]["metadata_hash"]
+                != manifest_entry["metadata_hash"]
+            ):
+                run_state["changed_metadata_chunks"][chunk_id] = document_chunk
+
+            if len(batch) >= self.config.index_ingest_batch_size:
+                sent_ids.update(batch)
+                yield list(batch.values())
+                batch = {}
+        if batch:
+            yield list(batch.values())
+        run_state["resumed_upserted_count"] = len(
+            (upserted_ids - sent_ids) & run_state["current_chunks"].keys()
+        )
 
-                except Exception as error:
-                    error_info = traceback.format_exc()
-                    self.log.print_and_log(f"An error occurred: {error}\n{error_info}")
-                    if i < retry_count - 1:  # i is zero indexed
-                        continue  # this will start the next iteration of loop thus retrying your code block
-                    else:
-                        raise  # if exception in the last retry then raise it.
+    def iter_source_chunks(self, data_source, run_state, preprocessor_executor=None):
+        # Yields (chunk_id, text_chunk, document_chunk, manifest_entry) for every chunk of the source
+        for doc_chunks in self.iter_document_chunks(
+            data_source, run_state, preprocessor_executor
+        ):
+            text_chunks, doc_chunks = data_source.preprocessor.create_text_chunks(
+                data_source, doc_chunks
+            )
+            for text_chunk, document_chunk in zip(text_chunks, doc_chunks):
+                run_state["document_chunks"].append(document_chunk)
+                chunk_id, manifest_entry = ChunkManifest.create_entry(
+                    data_source.data_source_name, text_chunk, document_chunk
+                )
+                yield chunk_id, text_chunk, document_chunk, manifest_entry
+
+    def collapse_duplicate_chunks(self, data_source, chunks, previous_chunks, run_state):
+        """Keeps one chunk of each group of identical chunks, and of near-identical ones with index_dedup_enabled.
+        Yields (chunk, superseded_id) as chunks are kept, without waiting for the whole source.
+        The kept copy doesn't depend on crawl order. Chunks already in the index sort first, then by
+        (url, chunk id), and a copy that sorts before the kept one replaces it as superseded_id.
+        Last run's indexed chunks are added to the deduplicator up front, so a new copy of one of them
+        waits for it instead of being embedded and then replaced.
+        """
+        indexed_ids = previous_chunks.keys() | data_source.checkpoint.upserted_ids
+
+        def sort_key(chunk_id, document_chunk):
+            return (chunk_id not in indexed_ids, document_chunk.get("url") or "", chunk_id)
+
+        def new_group():
+            # kept is the (chunk_id, document_chunk) passed on, pending a better copy not yet passed on
+            return {"seed_key": None, "best_key": None, "kept": None, "pending": None, "urls": []}
+
+        deduplicator = None
+        groups = {}
+        # Chunk id to the id of its group
+        group_ids = {}
+        if self.config.index_dedup_enabled:
+            deduplicator = MinHashDeduplicator(self.config.index_dedup_threshold)
+            with ChunkStore(data_source.chunk_store_path) as chunk_store:
+                for chunk_id, document_chunk in chunk_store.iter_chunks():
+                    if chunk_id not in previous_chunks or chunk_id in group_ids:
+                        continue
+                    group_id = (
+                        deduplicator.find_or_add(chunk_id, document_chunk["content"])
+                        or chunk_id
+                    )
+                    group_ids[chunk_id] = group_id
+                    group = groups.setdefault(group_id, new_group())
+                    seed_key = sort_key(chunk_id, document_chunk)
+                    if group["seed_key"] is None or seed_key < group["seed_key"]:
+                        group["seed_key"] = seed_key
+
+        for chunk in chunks:
+            chunk_id, _, document_chunk, _ = chunk
+            group_id = group_ids.get(chunk_id)
+            if group_id is None and deduplicator is not None:
+                group_id = deduplicator.find_or_add(chunk_id, document_chunk["content"])
+            if group_id is None:
+                group_id = chunk_id
+            group_ids[chunk_id] = group_id
+            group = groups.setdefault(group_id, new_group())
+            group["urls"].append(document_chunk.get("url"))
+            key = sort_key(chunk_id, document_chunk)
+            if group["best_key"] is not None and group["best_key"] <= key:
+                continue
+            group["best_key"] = key
+            if (
+                group["kept"] is None
+                and group["seed_key"] is not None
+                and key > group["seed_key"]
+            ):
+                # Waits for the indexed copy, which sorts first
+                group["pending"] = chunk
+                continue
+            superseded_id = group["kept"][0] if group["kept"] else None
+            group["kept"] = (chunk_id, document_chunk)
+            group["pending"] = None
+            yield chunk, superseded_id
+
+        for group in groups.values():
+            if group["pending"] is not None:
+                # The indexed copy it waited for wasn't seen this run
+                chunk = group["pending"]
+                group["kept"] = (chunk[0], chunk[2])
+                yield chunk, None
+            if group["kept"] is not None and len(group["urls"]) > 1:
+                run_state["duplicate_count"] += len(group["urls"]) - 1
+                run_state["duplicate_urls"][group["kept"][0]] = (
+                    group["kept"][1],
+                    set(group["urls"]),
+                )
 
-        self.log.print_and_log(
-            f"Final index stats: {self.vectorstore.describe_index_stats()}"
+    def merge_duplicate_urls(self, data_source, previous_chunks, run_state):
+        """Lists the urls of collapsed duplicates in their indexed chunk's metadata.
+        Runs once all chunks are seen, so new chunks get these as a metadata update after their upsert.
+        """
+        for chunk_id, (document_chunk, urls) in run_state["duplicate_urls"].items():
+            urls = sorted(url for url in urls if url and url != document_chunk.get("url"))
+            if not urls:
+                continue
+            document_chunk = {
+                **document_chunk,
+                "duplicate_urls": urls[: self.config.index_dedup_max_urls],
+            }
+            manifest_entry = run_state["current_chunks"][chunk_id]
+            manifest_entry["metadata_hash"] = ChunkManifest.metadata_hash(document_chunk)
+            manifest_entry["has_duplicate_urls"] = True
+            previous_entry = previous_chunks.get(chunk_id)
+            if (
+                previous_entry is None
+                or previous_entry["metadata_hash"] != manifest_entry["metadata_hash"]
+            ):
+                run_state["changed_metadata_chunks"][chunk_id] = document_chunk
+            else:
+                run_state["changed_metadata_chunks"].pop(chunk_id, None)
+
+        # Updates merge into the vector's metadata, so urls that are gone have to be cleared explicitly
+        for chunk_id, document_chunk in run_state["changed_metadata_chunks"].items():
+            previous_entry = previous_chunks.get(chunk_id)
+            if (
+                previous_entry
+                and previous_entry.get("has_duplicate_urls")
+                and "duplicate_urls" not in document_chunk
+            ):
+                run_state["changed_metadata_chunks"][chunk_id] = {
+                    **document_chunk,
+                    "duplicate_urls": [],
+                }
+
+        chunk_count = len(run_state["current_chunks"]) + run_state["duplicate_count"]
+        if run_state["duplicate_count"]:
+            data_source.print_and_log(
+                f"Duplicate chunks collapsed: {run_state['duplicate_count']} of {chunk_count} ({run_state['duplicate_count'] / chunk_count:.1%})"
+            )
+
+    def embed_chunk_batch(self, data_source, batch):
+        # The scheduler splits the batch into concurrent requests
+        dense_embeddings = data_source.embedding_retriever.embed_documents(
+            [chunk["text_chunk"] for chunk in batch]
         )
+        # A resumed run gets these back from the embedding cache
+        data_source.checkpoint.record("embedded", ids=[chunk["id"] for chunk in batch])
+        return [
+            {
+                "id": chunk["id"],
+                "values": dense_embedding,
+                "metadata": chunk["document_chunk"],
+            }
+            for chunk, dense_embedding in zip(batch, dense_embeddings)
+        ]
 
     def delete_index(self):
         self.log.print_and_log(f"Deleting index {self.index_name}")
@@ -245,12 +753,76 @@ class IndexService:
         self.log.print_and_log(
             f"Clearing namespace aka deployment: {self.deployment_name}"
         )
-        self.vectorstore.delete(deleteAll="true", namespace=self.deployment_name)
+        stats = self.vectorstore.describe_index_stats()
+        for key in stats["namespaces"]:
+            # Partitioned namespaces are prefixed with the deployment name
+            if key == self.deployment_name or key.startswith(
+                f"{self.deployment_name}_"
+            ):
+                self.vectorstore.delete(deleteAll="true", namespace=key)
         self.log.print_and_log(self.vectorstore.describe_index_stats())
 
+    def migrate_namespace_layout(self):
+        """Moves vectors from the deployment namespace into partitioned namespaces.
+        Pinecone can't list ids, so vectors are found by querying with a
+        data_domain_name/doc_type filter until none are left.
+        """
+        if self.index_namespace_layout != "partitioned":
+            raise ValueError(
+                "Set index_namespace_layout: partitioned in index_description.yaml before migrating."
+            )
+
+        partitions = set()
+        for domain in self.index_description_file["data_domains"]:
+            for _, source in domain["sources"].items():
+                partitions.add((domain["name"], source.get("doc_type")))
+
+        # Any non-zero vector works since we only need the filter to match
+        placeholder_vector = [1.0] * self.config.index_vectorstore_dimension
+        for data_domain_name, doc_type in sorted(partitions):
+            target_namespace = self.deployment_instance.get_index_namespace(
+                data_domain_name, doc_type
+            )
+            moved_count = 0
+            while True:
+                query_response = self.vectorstore.query(
+                    top_k=self.config.index_migration_batch_size,
+                    include_values=True,
+                    include_metadata=True,
+                    namespace=self.deployment_name,
+                    filter={
+                        "data_domain_name": {"$eq": data_domain_name},
+                        "doc_type": {"$eq": doc_type},
+                    },
+                    vector=placeholder_vector,
+                )
+                if not query_response.matches:
+                    break
+                vectors_to_upsert = [
+                    {"id": m.id, "values": m.values, "metadata": m.metadata}
+                    for m in query_response.matches
+                ]
+                self.vectorstore.upsert(
+                    vectors=vectors_to_upsert,
+                    namespace=target_namespace,
+                    batch_size=self.config.index_vectorstore_upsert_batch_size,
+                )
+                self.vectorstore.delete(
+                    ids=[vector["id"] for vector in vectors_to_upsert],
+                    namespace=self.deployment_name,
+                )
+                moved_count += len(vectors_to_upsert)
+            self.log.print_and_log(
+                f"Moved {moved_count} vectors from {self.deployment_name} to {target_namespace}"
+            )
+
+        self.log.print_and_log(
+            f"Post-migration index stats: {self.vectorstore.describe_index_stats()}"
+        )
+
     def clear_data_source(self, data_source):
         data_source.vectorstore.delete(
-            namespace=self.deployment_name,
+            namespace=data_source.namespace,
             delete_all=False,
             filter={"data_source_name": {"$eq": data_source.data_source_name}},
         )
@@ -319,44 +891,28 @@ class DataSourceConfig:
         if not all(attr is not None and attr != "" for attr in attributes):
             raise ValueError("Some required fields are missing or have no value.")
 
+        self.namespace: str = index_agent.deployment_instance.get_index_namespace(
+            self.data_domain_name, self.doc_type
+        )
+        # Records the chunk ids currently in the vectorstore for this source
+        self.manifest_path: str = f"{index_agent.index_dir}/manifests/{self.data_domain_name}/{self.data_source_name}.json"
+        # Local copy of the source's chunks, see ChunkStore
+        self.chunk_store_path: str = f"{index_agent.index_dir}/outputs/{self.data_domain_name}/{self.data_source_name}/chunks.jsonl"
+        self.stored_chunks_by_url: dict = {}
+        # Process pool for CPU bound work during the current ingest, if any
+        self.process_executor = None
+        # Progress of the current ingest, see IngestCheckpoint
+        self.checkpoint_path: str = f"{index_agent.index_dir}/checkpoints/{self.data_domain_name}/{self.data_source_name}.jsonl"
+        self.checkpoint = IngestCheckpoint(self.checkpoint_path)
+        self.resume: bool = False
+
         match self.target_type:
             case "gitbook":
-                self.scraper = GitbookLoader(
-                    web_page=self.target_url, load_all_paths=self.load_all_paths
-                )
+                self.scraper = GitbookScraper(self)
                 self.content_type = "text"
 
             case "sitemap":
-                # May need to change for specific websites
-                def parse_content_by_id(content):
-                    # Attempt to find element by 'content-container' ID
-                    content_element = content.find(id="content-container")
-                    if not content_element:
-                        # If 'content-container' not found, attempt to find 'content'
-                        content_element = content.find(id="content")
-                    if not content_element:
-                        # If neither found, return an empty string
-                        return ""
-                    # Find all elements with "visibility: hidden" style and class containing "toc"
-                    unwanted_elements = content_element.select(
-                        '[style*="visibility: hidden"], [class*="toc"]'
-                    )
-                    # Remove unwanted elements from content_element
-                    for element in unwanted_elements:
-                        element.decompose()
-                    # Remove header tags
-                    for header in content_element.find_all("header"):
-                        header.decompose()
-                    # Extract text from the remaining content
-                    text = content_element.get_text(separator=" ")
-
-                    return text
-
-                self.scraper = SitemapLoader(
-                    self.target_url,
-                    filter_urls=[self.filter_url],
-                    parsing_function=parse_content_by_id,
-                )
+                self.scraper = SitemapScraper(self)
                 self.content_type = "text"
 
             case "generic":
@@ -382,39 +938,119 @@ class DataSourceConfig:
             case _:
                 raise ValueError("Invalid target type: should be text, html, or code.")
 
-        self.embedding_retriever = OpenAIEmbeddings(
-            model=self.config.index_embedding_model,
-            embedding_ctx_length=self.config.index_embedding_max_chunk_size,
-            openai_api_key=self.index_agent.secrets["openai_api_key"],
-            chunk_size=self.config.index_embedding_batch_size,
-            request_timeout=self.config.index_openai_timeout_seconds,
+        self.embedding_retriever = index_agent.embedding_retriever
+        if (
+            self.embedding_retriever is not None
+            and index_agent.embedding_cache is not None
+        ):
+            self.embedding_retriever = CachedEmbeddings(
+                self.embedding_retriever,
+                index_agent.embedding_cache,
+                self.embedding_retriever.model,
+                self.print_and_log,
+            )
+
+    def iter_documents(self):
+        # Loaders with lazy_load yield documents as they're read
+        if hasattr(self.scraper, "lazy_load"):
+            yield from self.scraper.lazy_load()
+        else:
+            yield from self.scraper.load() or []
+
+    def create_crawler(self, extractor):
+        return WebCrawler(
+            self.index_agent.http_cache,
+            self.data_source_name,
+            extractor,
+            max_connections=self.config.index_crawler_max_connections,
+            max_per_host=self.config.index_crawler_max_per_host,
+            timeout_seconds=self.config.index_crawler_timeout_seconds,
+            print_and_log=self.print_and_log,
         )
 
+    def load_stored_chunks_by_url(self):
+        # Last run's chunks grouped by page so unchanged pages can be carried forward
+        chunks_by_url = {}
+        with ChunkStore(self.chunk_store_path) as chunk_store:
+            for _, document_chunk in chunk_store.iter_chunks():
+                chunks_by_url.setdefault(document_chunk["url"], []).append(
+                    document_chunk
+                )
+        return chunks_by_url
+
+    def commit_crawl_cache(self):
+        # Crawled responses only become the basis for conditional requests once ingest succeeds
+        crawler = getattr(self.scraper, "crawler", None)
+        if crawler is not None:
+            crawler.commit()
+
+    def print_and_log(self, message):
+        # Prefixed so interleaved logs from parallel ingest can be told apart
+        if self.config.index_ingest_max_workers > 1:
+            message = f"[{self.data_source_name}] {message}"
+        self.log.print_and_log(message)
 
-class CustomScraper:
-    ### CustomScraper is a generic web scraper ###
+
+class SitemapScraper:
+    ### SitemapScraper crawls every url in a sitemap matching filter_url ###
 
     def __init__(self, data_source_config: DataSourceConfig):
         self.data_source_config = data_source_config
-        self.load_urls = RecursiveUrlLoader(
-            url=self.data_source_config.target_url, extractor=self.custom_extractor
+        # May need a different extractor for specific websites
+        self.crawler = data_source_config.create_crawler(extract_sitemap_page)
+
+    def load(self) -> Iterator[Document]:
+        return list(self.lazy_load())
+
+    def lazy_load(self) -> Iterator[Document]:
+        self.crawler.known_urls = set(self.data_source_config.stored_chunks_by_url)
+        self.crawler.extraction_executor = self.data_source_config.process_executor
+        self.crawler.resume = self.data_source_config.resume
+        yield from self.crawler.lazy_load_sitemap(
+            self.data_source_config.target_url,
+            filter_urls=[self.data_source_config.filter_url],
         )
 
-    @staticmethod
-    def custom_extractor(html_text: str) -> str:
-        soup = BeautifulSoup(html_text, "html.parser")
-        text_element = soup.find(id="content")
-        if text_element:
-            return text_element.get_text()
-        return ""
+
+class GitbookScraper:
+    ### GitbookScraper loads a gitbook page, or every page in its sitemap with load_all_paths ###
+
+    def __init__(self, data_source_config: DataSourceConfig):
+        self.data_source_config = data_source_config
+        self.crawler = data_source_config.create_crawler(extract_gitbook_page)
 
     def load(self) -> Iterator[Document]:
-        documents = self.load_urls.load()
+        return list(self.lazy_load())
 
-        return [
-            Document(page_content=doc.page_content, metadata=doc.metadata)
-            for doc in documents
-        ]
+    def lazy_load(self) -> Iterator[Document]:
+        self.crawler.known_urls = set(self.data_source_config.stored_chunks_by_url)
+        self.crawler.extraction_executor = self.data_source_config.process_executor
+        self.crawler.resume = self.data_source_config.resume
+        base_url = self.data_source_config.target_url.rstrip("/")
+        if self.data_source_config.load_all_paths:
+            yield from self.crawler.lazy_load_sitemap(f"{base_url}/sitemap.xml")
+        else:
+            yield from self.crawler.lazy_load_urls([base_url])
+
+
+class CustomScraper:
+    ### CustomScraper is a generic web scraper ###
+
+    def __init__(self, data_source_config: DataSourceConfig):
+        self.data_source_config = data_source_config
+        self.crawler = data_source_config.create_crawler(extract_generic_page)
+
+    def load(self) -> Iterator[Document]:
+        return list(self.lazy_load())
+
+    def lazy_load(self) -> Iterator[Document]:
+        self.crawler.known_urls = set(self.data_source_config.stored_chunks_by_url)
+        self.crawler.extraction_executor = self.data_source_config.process_executor
+        self.crawler.resume = self.data_source_config.resume
+        yield from self.crawler.lazy_load_recursive(
+            self.data_source_config.target_url,
+            max_depth=self.data_source_config.config.index_crawler_max_depth,
+        )
 
 
 class OpenAPILoader:
@@ -491,8 +1127,10 @@ class LoadTextFromFile:
 
 
     def load_texts(self):
+        return list(self.lazy_load())
+
+    def lazy_load(self):
         """Load text and JSON files and structure them in the desired format."""
-        text_documents = []
         allowed_extensions = [".txt", ".json"]
 
         for filename in os.listdir(self.data_source_config.target_url):
@@ -526,9 +1164,7 @@ class LoadTextFromFile:
                         "title": title
                     }
                     document = Document(page_content=content['content'], metadata=document_metadata)
-                text_documents.append(document)
-
-        return text_documents
+                yield document
 
 
 
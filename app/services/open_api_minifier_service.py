@@ -55,7 +55,8 @@ class OpenAPIMinifierService:
 
         self.key_abbreviations_enabled = True
 
-    def run(self, open_api_specs):
+    def run(self, open_api_specs, executor=None):
+        # executor is unused; specs are minified in a single pass
         # Merge all specs and save a copy locally
         full_open_api_specs = self.create_full_spec(open_api_specs)
 
@@ -553,36 +554,6 @@ class OpenAPIMinifierService:
         with open(output_file_path, "w") as output_file:
             output_file.write(output_string)
 
-    def compare_chunks(self, data_source, document_chunks):
-        folder_path = f"{self.index_agent.index_dir}/outputs/{self.data_source_config.data_domain_name}/open_api_spec/endpoints"
-        # Create the directory if it does not exist
-        os.makedirs(folder_path, exist_ok=True)
-        existing_files = os.listdir(folder_path)
-        has_changes = False
-        # This will hold the titles of new or different chunks
-        new_or_changed_chunks = []
-        for document_chunk in document_chunks:
-            text_chunk = f"{document_chunk['content']} title: {document_chunk['title']}"
-            # Skip overly long chunks
-            if (
-                self.tiktoken_len(text_chunk)
-                > self.config.index_text_splitter_max_length
-            ):
-                continue
-            file_name = f"{document_chunk['title']}.txt"
-            if file_name not in existing_files:
-                has_changes = True
-                new_or_changed_chunks.append(document_chunk["title"])
-            else:
-                existing_file_path = os.path.join(folder_path, file_name)
-                with open(existing_file_path, "r") as f:
-                    existing_data = json.load(f)
-                    if existing_data != document_chunk:
-                        has_changes = True
-                        new_or_changed_chunks.append(document_chunk["title"])
-
-        return has_changes, new_or_changed_chunks
-
     def create_text_chunks(self, data_source, document_chunks):
         checked_document_chunks = []
         checked_text_chunks = []
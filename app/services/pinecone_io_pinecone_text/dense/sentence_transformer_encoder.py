@@ -1,7 +1,14 @@
-import torch
+import numpy as np
 from typing import Optional, Union, List
-from sentence_transformers import SentenceTransformer
-from pinecone_text.dense.base_dense_ecoder import BaseDenseEncoder
+from services.pinecone_io_pinecone_text.dense.base_dense_ecoder import BaseDenseEncoder
+
+try:
+    import torch
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    # Optional, only needed for the local embedding backend
+    torch = None
+    SentenceTransformer = None
 
 
 class SentenceTransformerEncoder(BaseDenseEncoder):
@@ -10,7 +17,18 @@ class SentenceTransformerEncoder(BaseDenseEncoder):
         document_encoder_name: str,
         query_encoder_name: Optional[str] = None,
         device: Optional[str] = None,
+        batch_size: int = 32,
+        processes: int = 0,
     ):
+        """
+        Args:
+            batch_size: texts per forward pass. Texts are sorted by length first so each batch pads to similar lengths.
+            processes: CPU processes used by encode_documents. 0 encodes in the calling process.
+        """
+        if SentenceTransformer is None:
+            raise ImportError(
+                "The local embedding backend requires torch and sentence-transformers: pip install sentence-transformers"
+            )
         device = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.document_encoder = SentenceTransformer(
             document_encoder_name, device=device
@@ -19,17 +37,45 @@ class SentenceTransformerEncoder(BaseDenseEncoder):
             self.query_encoder = SentenceTransformer(query_encoder_name, device=device)
         else:
             self.query_encoder = self.document_encoder
+        self.batch_size = batch_size
+        self.processes = processes
+        self.pool = None
+
+    def encode_documents(self, texts: Union[str, List[str]]) -> np.ndarray:
+        if self.processes > 0 and self.pool is None:
+            self.pool = self.document_encoder.start_multi_process_pool(
+                target_devices=["cpu"] * self.processes
+            )
+        return self._encode(self.document_encoder, texts, self.pool)
 
-    def encode_documents(
-        self, texts: Union[str, List[str]]
-    ) -> Union[List[float], List[List[float]]]:
-        return self.document_encoder.encode(
-            texts, show_progress_bar=False, convert_to_numpy=True
-        ).tolist()
+    def encode_queries(self, texts: Union[str, List[str]]) -> np.ndarray:
+        return self._encode(self.query_encoder, texts)
 
-    def encode_queries(
-        self, texts: Union[str, List[str]]
-    ) -> Union[List[float], List[List[float]]]:
-        return self.query_encoder.encode(
-            texts, show_progress_bar=False, convert_to_numpy=True
-        ).tolist()
+    def close(self):
+        if self.pool is not None:
+            self.document_encoder.stop_multi_process_pool(self.pool)
+            self.pool = None
+
+    def _encode(self, encoder, texts, pool=None):
+        """Returns float32 embeddings in the order of texts, one row per text."""
+        if isinstance(texts, str):
+            return self._encode(encoder, [texts], pool)[0]
+        if not texts:
+            return np.empty((0, encoder.get_sentence_embedding_dimension()), np.float32)
+        # Longest first, so batches (and each process's share) hold similar lengths
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        sorted_texts = [texts[i] for i in order]
+        if pool is not None:
+            sorted_embeddings = encoder.encode_multi_process(
+                sorted_texts, pool, batch_size=self.batch_size
+            )
+        else:
+            sorted_embeddings = encoder.encode(
+                sorted_texts,
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            )
+        embeddings = np.empty(sorted_embeddings.shape, dtype=np.float32)
+        embeddings[order] = sorted_embeddings
+        return embeddings
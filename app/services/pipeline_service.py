@@ -0,0 +1,94 @@
+import queue
+import threading
+
+_END = object()
+
+
+class BoundedPipeline:
+    """Runs items from a source iterator through a chain of stages, each stage on its own thread.
+    Stages are connected by bounded queues so a slow stage blocks the ones before it,
+    which caps memory at roughly queue_size items per stage.
+    """
+
+    def __init__(self, stages, queue_size=4):
+        # Each stage takes one item and returns one item, or None to drop it
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+
+    def run(self, source):
+        """Yields the last stage's outputs in order. Raises the first error from any stage."""
+        stop = threading.Event()
+        errors = []
+        queues = [
+            queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+
+        def put(out_queue, item):
+            # Blocks while the queue is full unless the pipeline is stopping
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(in_queue):
+            while not stop.is_set():
+                try:
+                    return in_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _END
+
+        def feed():
+            try:
+                for item in source:
+                    if not put(queues[0], item):
+                        return
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                put(queues[0], _END)
+
+        def work(stage, in_queue, out_queue):
+            try:
+                while True:
+                    item = get(in_queue)
+                    if item is _END:
+                        break
+                    result = stage(item)
+                    if result is not None and not put(out_queue, result):
+                        return
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                put(out_queue, _END)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(
+                threading.Thread(
+                    target=work,
+                    args=(stage, queues[i], queues[i + 1]),
+                    daemon=True,
+                )
+            )
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is _END:
+                    break
+                yield item
+            if errors:
+                raise errors[0]
+        finally:
+            # Also reached when the consumer raises or stops early
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -1,13 +1,22 @@
 # region
 import os
+import math
+import time
+import threading
+import concurrent.futures
 import traceback
 import json, yaml, re
 import openai, pinecone, tiktoken
+import numpy as np
 from langchain.embeddings import OpenAIEmbeddings
 from services.log_service import Logger
+from services.embedding_service import LocalEmbeddings
 
 # endregion
 
+# pinecone.init sets module globals that each pinecone.Index copies when it's created
+_pinecone_init_lock = threading.Lock()
+
 
 class ShelbyAgent:
     def __init__(self, moniker_instance, config):
@@ -27,6 +36,10 @@ class ShelbyAgent:
         self.data_domains = moniker_instance.moniker_data_domains
         self.index_env = moniker_instance.deployment_instance.index_env
         self.index_name = moniker_instance.deployment_instance.index_name
+        self.deployment_instance = moniker_instance.deployment_instance
+        self.index_namespace_layout = (
+            moniker_instance.deployment_instance.index_namespace_layout
+        )
         self.action_agent = ActionAgent(self)
         self.ceq_agent = CEQAgent(self)
 
@@ -194,6 +207,9 @@ class CEQAgent:
         self.config = shelby_agent.config
         self.secrets = shelby_agent.secrets
         self.data_domains = shelby_agent.data_domains
+        # Loaded on the first query and reused after that
+        self.local_embeddings = None
+        self.pinecone_indexes = {}
 
     def select_data_domain(self, query):
         response = None
@@ -252,6 +268,13 @@ class CEQAgent:
         return generated_keywords
 
     def get_query_embeddings(self, query):
+        if self.config.ceq_embedding_backend == "local":
+            if self.local_embeddings is None:
+                self.local_embeddings = LocalEmbeddings(
+                    self.config.ceq_embedding_local_model
+                )
+            return self.local_embeddings.embed_query(query)
+
         embedding_retriever = OpenAIEmbeddings(
             # Note that this is openai_api_key and not api_key
             openai_api_key=self.secrets["openai_api_key"],
@@ -262,83 +285,278 @@ class CEQAgent:
 
         return dense_embedding
 
+    def get_pinecone_index(self, index_name, environment, api_key_secret):
+        # Federated sources may live in another Pinecone project with its own environment and key
+        api_key = self.secrets.get(api_key_secret) or os.environ.get(
+            f"{self.shelby_agent.deployment_name.upper()}_{api_key_secret.upper()}"
+        )
+        index_key = (index_name, environment, api_key_secret)
+        with _pinecone_init_lock:
+            if index_key not in self.pinecone_indexes:
+                pinecone.init(api_key=api_key, environment=environment)
+                self.pinecone_indexes[index_key] = pinecone.Index(index_name)
+            return self.pinecone_indexes[index_key]
+
     def query_vectorstore(self, dense_embedding, data_domain_name=None):
         # def query_vectorstore(self, dense_embedding, sparse_embedding, data_domain_name=None):
 
-        pinecone.init(
-            api_key=self.secrets["pinecone_api_key"],
-            environment=self.shelby_agent.index_env,
-        )
-        index = pinecone.Index(self.shelby_agent.index_name)
-
         if data_domain_name is None:
             data_domain_names = []
             for field, _ in self.data_domains.items():
                 data_domain_names.append(field)
+        else:
+            data_domain_names = [data_domain_name]
 
-            soft_filter = {
-                "doc_type": {"$eq": "soft"},
-                "data_domain_name": {"$in": data_domain_names},
-            }
-
-            hard_filter = {
-                "doc_type": {"$eq": "hard"},
-                "data_domain_name": {"$in": data_domain_names},
-            }
+        top_k = self.config.ceq_docs_to_retrieve
+        if self.config.ceq_mmr_enabled:
+            # Over-fetch candidates so MMR has something to diversify from
+            top_k = top_k * self.config.ceq_mmr_fetch_multiplier
 
+        # Without federated sources the deployment's own index is the only source
+        federated = bool(self.config.ceq_federated_sources)
+        if federated:
+            sources = self.config.ceq_federated_sources
         else:
-            soft_filter = {
-                "doc_type": {"$eq": "soft"},
-                "data_domain_name": {"$eq": data_domain_name},
-            }
-            hard_filter = {
-                "doc_type": {"$eq": "hard"},
-                "data_domain_name": {"$eq": data_domain_name},
-            }
+            sources = [{"index_name": self.shelby_agent.index_name}]
+
+        queries = []
+        for source_num, source in enumerate(sources):
+            index_name = source.get("index_name", self.shelby_agent.index_name)
+            timeout = None
+            if federated:
+                timeout = source.get(
+                    "timeout_seconds", self.config.ceq_federated_timeout_seconds
+                )
+            try:
+                index = self.get_pinecone_index(
+                    index_name,
+                    source.get("environment", self.shelby_agent.index_env),
+                    source.get("api_key_secret", "pinecone_api_key"),
+                )
+            except Exception as error:
+                if not federated:
+                    raise
+                self.shelby_agent.log.print_and_log(
+                    f"Skipping source {index_name}: {repr(error)}"
+                )
+                continue
+            if "filter" in source:
+                # The source's own filter replaces the local doc_type and data_domain filters
+                # Its matches are grouped by their doc_type metadata, if any
+                queries.append(
+                    {
+                        "source_num": source_num,
+                        "doc_type": None,
+                        "index_name": index_name,
+                        "index": index,
+                        "namespace": source.get(
+                            "namespace", self.shelby_agent.deployment_name
+                        ),
+                        "filter": source["filter"],
+                        "timeout": timeout,
+                    }
+                )
+                continue
+            for doc_type in ["soft", "hard"]:
+                query = {
+                    "source_num": source_num,
+                    "doc_type": doc_type,
+                    "index_name": index_name,
+                    "index": index,
+                    "namespace": self.shelby_agent.deployment_name,
+                    "filter": {
+                        "doc_type": {"$eq": doc_type},
+                        "data_domain_name": {"$in": data_domain_names},
+                    },
+                    "timeout": timeout,
+                }
+                if "namespace" in source:
+                    query["namespace"] = source["namespace"]
+                    queries.append(query)
+                elif (
+                    self.shelby_agent.index_namespace_layout == "partitioned"
+                    and index_name == self.shelby_agent.index_name
+                ):
+                    # Each partition holds a single data_domain and doc_type so no filter is needed
+                    for name in data_domain_names:
+                        partition_query = dict(query)
+                        partition_query[
+                            "namespace"
+                        ] = self.shelby_agent.deployment_instance.get_index_namespace(
+                            name, doc_type
+                        )
+                        partition_query["filter"] = None
+                        queries.append(partition_query)
+                else:
+                    queries.append(query)
+
+        def _query(index, namespace, doc_filter):
+            return index.query(
+                top_k=top_k,
+                include_values=self.config.ceq_mmr_enabled,
+                namespace=namespace,
+                include_metadata=True,
+                filter=doc_filter,
+                vector=dense_embedding
+                # sparse_vector=sparse_embedding
+            )
 
-        soft_query_response = index.query(
-            top_k=self.config.ceq_docs_to_retrieve,
-            include_values=False,
-            namespace=self.shelby_agent.deployment_name,
-            include_metadata=True,
-            filter=soft_filter,
-            vector=dense_embedding
-            # sparse_vector=sparse_embedding
-        )
-        hard_query_response = index.query(
-            top_k=self.config.ceq_docs_to_retrieve,
-            include_values=False,
-            namespace=self.shelby_agent.deployment_name,
-            include_metadata=True,
-            filter=hard_filter,
-            vector=dense_embedding
-            # sparse_vector=sparse_embedding
-        )
+        if not queries:
+            # Every federated source failed to connect
+            self.shelby_agent.log.print_and_log("No sources available to query.")
+            return []
+
+        # Runs all queries concurrently
+        # shutdown(wait=False) keeps a slow source from blocking the answer after it times out
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(queries))
+        start_time = time.monotonic()
+        futures = [
+            executor.submit(
+                _query, query["index"], query["namespace"], query["filter"]
+            )
+            for query in queries
+        ]
+        source_results = {}
+        try:
+            for query, future in zip(queries, futures):
+                timeout = query["timeout"]
+                if timeout is not None:
+                    timeout = max(0, start_time + timeout - time.monotonic())
+                try:
+                    query_response = future.result(timeout=timeout)
+                except Exception as error:
+                    if not federated:
+                        raise
+                    self.shelby_agent.log.print_and_log(
+                        f"Skipping source {query['index_name']}/{query['namespace']}: {repr(error)}"
+                    )
+                    continue
+                for document in self.parse_query_response(query_response):
+                    doc_type = query["doc_type"] or document["doc_type"]
+                    source_results.setdefault(
+                        (query["source_num"], doc_type), []
+                    ).append(document)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        # Destructures the QueryResponse object the pinecone library generates.
         returned_documents = []
-        for m in soft_query_response.matches:
-            response = {
-                "content": m.metadata["content"],
-                "title": m.metadata["title"],
-                "url": m.metadata["url"],
-                "doc_type": m.metadata["doc_type"],
-                "score": m.score,
-                "id": m.id,
-            }
-            returned_documents.append(response)
-        for m in hard_query_response.matches:
+        for doc_type in ["soft", "hard"]:
+            source_lists = []
+            for source_num in range(len(sources)):
+                documents = source_results.get((source_num, doc_type), [])
+                source_lists.append(
+                    sorted(documents, key=lambda x: x["score"], reverse=True)
+                )
+            if federated:
+                documents = self.fuse_source_scores(source_lists)
+            else:
+                documents = sorted(
+                    source_lists[0], key=lambda x: x["score"], reverse=True
+                )
+            documents = documents[:top_k]
+            if self.config.ceq_mmr_enabled:
+                documents = self.mmr_select(
+                    dense_embedding, documents, self.config.ceq_docs_to_retrieve
+                )
+            returned_documents.extend(documents)
+
+        return returned_documents
+
+    def fuse_source_scores(self, source_lists):
+        """Merges ranked lists from several sources into one.
+        Scores from different indexes aren't comparable, so they are normalized first
+        with either min_max or reciprocal rank fusion (rrf).
+        Docs returned by more than one source are merged on their content.
+        """
+        rrf_k = 60
+        fused_documents = {}
+        for documents in source_lists:
+            if not documents:
+                continue
+            high_score = documents[0]["score"]
+            low_score = documents[-1]["score"]
+            for rank, document in enumerate(documents):
+                match self.config.ceq_federated_score_normalization:
+                    case "min_max":
+                        if high_score == low_score:
+                            normalized_score = 1.0
+                        else:
+                            normalized_score = (document["score"] - low_score) / (
+                                high_score - low_score
+                            )
+                    case _:
+                        normalized_score = 1 / (rrf_k + rank + 1)
+                key = document["content"]
+                if key not in fused_documents:
+                    document["score"] = normalized_score
+                    fused_documents[key] = document
+                elif self.config.ceq_federated_score_normalization == "min_max":
+                    fused_documents[key]["score"] = max(
+                        fused_documents[key]["score"], normalized_score
+                    )
+                else:
+                    fused_documents[key]["score"] += normalized_score
+
+        return sorted(fused_documents.values(), key=lambda x: x["score"], reverse=True)
+
+    def parse_query_response(self, query_response):
+        # Destructures the QueryResponse object the pinecone library generates.
+        documents = []
+        for m in query_response.matches:
+            # Federated indexes may not have all of this deployment's metadata fields
             response = {
                 "content": m.metadata["content"],
-                "title": m.metadata["title"],
-                "url": m.metadata["url"],
-                "doc_type": m.metadata["doc_type"],
+                "title": m.metadata.get("title", ""),
+                "url": m.metadata.get("url", ""),
+                "doc_type": m.metadata.get("doc_type", "soft"),
                 "score": m.score,
                 "id": m.id,
             }
-            returned_documents.append(response)
+            if m.values:
+                response["values"] = m.values
+            documents.append(response)
+
+        return documents
+
+    def mmr_select(self, dense_embedding, documents, k):
+        """Maximal marginal relevance selection of k documents.
+        Balances similarity to the query against similarity to docs already selected,
+        weighted by ceq_mmr_lambda (1.0 is pure relevance).
+        """
+        if len(documents) <= k:
+            for document in documents:
+                document.pop("values", None)
+            return documents
 
-        return returned_documents
+        doc_vectors = np.array([doc["values"] for doc in documents], dtype=np.float32)
+        doc_vectors = doc_vectors / (
+            np.linalg.norm(doc_vectors, axis=1, keepdims=True) + 1e-10
+        )
+        # Copied so the caller's embedding isn't normalized in place
+        query_vector = np.array(dense_embedding, dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) + 1e-10)
+
+        relevance = doc_vectors @ query_vector
+        similarity = doc_vectors @ doc_vectors.T
+        mmr_lambda = self.config.ceq_mmr_lambda
+
+        selected = [int(np.argmax(relevance))]
+        # Highest similarity of each candidate to any selected doc
+        max_similarity = similarity[selected[0]].copy()
+        while len(selected) < k:
+            mmr_scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+            mmr_scores[selected] = -np.inf
+            next_doc = int(np.argmax(mmr_scores))
+            selected.append(next_doc)
+            np.maximum(max_similarity, similarity[next_doc], out=max_similarity)
+
+        selected_documents = []
+        for doc_index in selected:
+            document = documents[doc_index]
+            document.pop("values", None)
+            selected_documents.append(document)
+
+        return selected_documents
 
     def doc_relevancy_check(self, query, documents=None):
         with open(
@@ -404,7 +622,220 @@ class CEQAgent:
 
         return relevant_documents
 
-    def ceq_parse_documents(self, returned_documents=None):
+    def ceq_merge_overlapping_documents(self, returned_documents=None):
+        """Merges chunks from the same url whose texts overlap.
+        DFSTextSplitter adds forward and backwards overlap to each chunk,
+        so neighboring chunks share text that would otherwise be sent twice.
+        """
+
+        def _suffix_prefix_overlap(text_a, text_b):
+            # Length of the longest suffix of text_a that is also a prefix of text_b
+            # Computed with the KMP failure function over text_b + sentinel + text_a
+            combined = text_b + "\x00" + text_a
+            failure = [0] * len(combined)
+            for i in range(1, len(combined)):
+                k = failure[i - 1]
+                while k > 0 and combined[i] != combined[k]:
+                    k = failure[k - 1]
+                if combined[i] == combined[k]:
+                    k += 1
+                failure[i] = k
+            return failure[-1]
+
+        def _merge_pair(doc_a, doc_b):
+            # Returns the merged document or None if they don't overlap
+            min_chars = self.config.ceq_merge_overlapping_docs_min_chars
+            a_then_b = _suffix_prefix_overlap(doc_a["content"], doc_b["content"])
+            b_then_a = _suffix_prefix_overlap(doc_b["content"], doc_a["content"])
+            if max(a_then_b, b_then_a) < min_chars:
+                return None
+            if a_then_b >= b_then_a:
+                content = doc_a["content"] + doc_b["content"][a_then_b:]
+            else:
+                content = doc_b["content"] + doc_a["content"][b_then_a:]
+            # The merged doc inherits the metadata of the best scoring chunk
+            merged_document = dict(max(doc_a, doc_b, key=lambda x: x["score"]))
+            merged_document["content"] = content
+            merged_document["merged_ids"] = doc_a.get(
+                "merged_ids", [doc_a["id"]]
+            ) + doc_b.get("merged_ids", [doc_b["id"]])
+            return merged_document
+
+        if not returned_documents:
+            return returned_documents
+
+        tokenizer = tiktoken.encoding_for_model(self.config.ceq_tiktoken_encoding_model)
+        tokens_before = sum(
+            len(tokenizer.encode(doc["content"], disallowed_special=()))
+            for doc in returned_documents
+        )
+
+        # Groups docs by url and doc_type so only chunks from the same source are merged
+        grouped_documents = {}
+        for document in returned_documents:
+            key = (document["url"], document["doc_type"])
+            grouped_documents.setdefault(key, []).append(document)
+
+        merged_documents = []
+        for documents in grouped_documents.values():
+            # Merging can create a new overlap, so repeat until nothing changes
+            merged = True
+            while merged and len(documents) > 1:
+                merged = False
+                for i in range(len(documents)):
+                    for j in range(i + 1, len(documents)):
+                        merged_document = _merge_pair(documents[i], documents[j])
+                        if merged_document is not None:
+                            documents.pop(j)
+                            documents[i] = merged_document
+                            merged = True
+                            break
+                    if merged:
+                        break
+            merged_documents.extend(documents)
+
+        tokens_after = 0
+        for document in merged_documents:
+            document["token_count"] = len(
+                tokenizer.encode(document["content"], disallowed_special=())
+            )
+            tokens_after += document["token_count"]
+
+        if len(merged_documents) < len(returned_documents):
+            self.shelby_agent.log.print_and_log(
+                f"Merged {len(returned_documents)} overlapping docs into {len(merged_documents)}. Context tokens: {tokens_before} -> {tokens_after}"
+            )
+
+        return merged_documents
+
+    def ceq_compress_documents(self, query, documents, token_budget):
+        """Extractive compression of context docs to fit token_budget.
+        Sentences are scored against the query with BM25 computed locally over the retrieved sentences.
+        Each doc keeps its best sentence first so more sources stay represented,
+        then the remaining budget is filled by the highest scoring sentences.
+        """
+        tokenizer = tiktoken.encoding_for_model(self.config.ceq_tiktoken_encoding_model)
+
+        def _terms(text):
+            return [term for term in re.findall(r"\w+", text.lower()) if len(term) > 2]
+
+        query_terms = set(_terms(query))
+
+        sentences = []
+        for doc_index, document in enumerate(documents):
+            doc_sentences = re.split(r"(?<=[.!?])\s+|\n+", document["content"])
+            for position, sentence in enumerate(doc_sentences):
+                sentence = sentence.strip()
+                if not sentence:
+                    continue
+                sentences.append(
+                    {
+                        "doc_index": doc_index,
+                        "position": position,
+                        "text": sentence,
+                        "terms": _terms(sentence),
+                        "token_count": len(
+                            tokenizer.encode(sentence, disallowed_special=())
+                        ),
+                    }
+                )
+        if not sentences:
+            return documents
+
+        # BM25 with the retrieved sentences as the corpus
+        k1 = 1.5
+        b = 0.75
+        document_frequency = {}
+        for sentence in sentences:
+            for term in set(sentence["terms"]) & query_terms:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        average_length = sum(len(s["terms"]) for s in sentences) / len(sentences) or 1
+        for sentence in sentences:
+            score = 0.0
+            length_norm = k1 * (1 - b + b * len(sentence["terms"]) / average_length)
+            for term in query_terms:
+                term_frequency = sentence["terms"].count(term)
+                if term_frequency == 0:
+                    continue
+                df = document_frequency[term]
+                idf = math.log(1 + (len(sentences) - df + 0.5) / (df + 0.5))
+                score += (
+                    idf * term_frequency * (k1 + 1) / (term_frequency + length_norm)
+                )
+            sentence["score"] = score
+
+        # Ties fall back to the vectorstore score of the parent doc
+        ranked_sentences = sorted(
+            sentences,
+            key=lambda s: (s["score"], documents[s["doc_index"]]["score"]),
+            reverse=True,
+        )
+        # Each kept sentence may also bring a " ... " gap marker when it's joined back
+        separator_tokens = len(tokenizer.encode(" ... ", disallowed_special=()))
+        selected = set()
+        used_tokens = 0
+        represented_docs = set()
+        for sentence in ranked_sentences:
+            if sentence["doc_index"] in represented_docs:
+                continue
+            sentence_tokens = sentence["token_count"] + separator_tokens
+            if used_tokens + sentence_tokens <= token_budget:
+                selected.add(id(sentence))
+                used_tokens += sentence_tokens
+            represented_docs.add(sentence["doc_index"])
+        for sentence in ranked_sentences:
+            if id(sentence) in selected:
+                continue
+            sentence_tokens = sentence["token_count"] + separator_tokens
+            if used_tokens + sentence_tokens <= token_budget:
+                selected.add(id(sentence))
+                used_tokens += sentence_tokens
+
+        def _rebuild_documents():
+            # Rebuild each doc from its kept sentences in their original order
+            compressed_documents = []
+            for doc_index, document in enumerate(documents):
+                kept_sentences = []
+                last_position = None
+                for sentence in sentences:
+                    if sentence["doc_index"] != doc_index or id(sentence) not in selected:
+                        continue
+                    if (
+                        last_position is not None
+                        and sentence["position"] != last_position + 1
+                    ):
+                        kept_sentences.append("...")
+                    kept_sentences.append(sentence["text"])
+                    last_position = sentence["position"]
+                if not kept_sentences:
+                    continue
+                compressed_document = dict(document)
+                compressed_document["content"] = " ".join(kept_sentences)
+                compressed_document["token_count"] = len(
+                    tokenizer.encode(compressed_document["content"], disallowed_special=())
+                )
+                compressed_documents.append(compressed_document)
+            return compressed_documents
+
+        compressed_documents = _rebuild_documents()
+        used_tokens = sum(doc["token_count"] for doc in compressed_documents)
+        # Tokens can merge across joins, so the joined docs are checked against the budget too
+        for sentence in reversed(ranked_sentences):
+            if used_tokens <= token_budget:
+                break
+            if id(sentence) not in selected:
+                continue
+            selected.discard(id(sentence))
+            compressed_documents = _rebuild_documents()
+            used_tokens = sum(doc["token_count"] for doc in compressed_documents)
+
+        self.shelby_agent.log.print_and_log(
+            f"Compressed context docs to {used_tokens} tokens keeping {len(selected)} of {len(sentences)} sentences from {len(compressed_documents)} docs"
+        )
+
+        return compressed_documents
+
+    def ceq_parse_documents(self, returned_documents=None, query=None):
         def _tiktoken_len(document):
             tokenizer = tiktoken.encoding_for_model(
                 self.config.ceq_tiktoken_encoding_model
@@ -434,6 +865,22 @@ class CEQAgent:
             returned_documents, key=lambda x: x["score"], reverse=True
         )
 
+        # Compress sentences instead of dropping whole docs when over budget
+        if self.config.ceq_docs_compression_enabled and query:
+            if (
+                _docs_tiktoken_len(sorted_documents)
+                > self.config.ceq_docs_max_total_tokens
+            ):
+                sorted_documents = self.ceq_compress_documents(
+                    query, sorted_documents, self.config.ceq_docs_max_total_tokens
+                )
+                hard_count = sum(
+                    1 for doc in sorted_documents if doc["doc_type"] == "hard"
+                )
+                soft_count = sum(
+                    1 for doc in sorted_documents if doc["doc_type"] == "soft"
+                )
+
         for i, document in enumerate(sorted_documents, start=1):
             token_count = _tiktoken_len(document["content"])
             if token_count > self.config.ceq_docs_max_total_tokens:
@@ -677,7 +1124,12 @@ class CEQAgent:
                     f"{len(returned_documents)} documents returned from doc_check: {returned_documents_list}"
                 )
 
-            parsed_documents = self.ceq_parse_documents(returned_documents)
+            if self.config.ceq_merge_overlapping_docs_enabled:
+                returned_documents = self.ceq_merge_overlapping_documents(
+                    returned_documents
+                )
+
+            parsed_documents = self.ceq_parse_documents(returned_documents, query)
             final_documents_list = []
             for parsed_document in parsed_documents:
                 final_documents_list.append(parsed_document["url"])
@@ -0,0 +1,114 @@
+import time
+import json
+import random
+import concurrent.futures
+import numpy as np
+
+
+class VectorUpserter:
+    """Upserts vectors with batches sized by their serialized bytes rather than a fixed count.
+    Batches are sent several at a time and only failed batches are retried.
+    Values are rounded and empty metadata fields dropped to keep payloads small.
+    """
+
+    def __init__(
+        self,
+        vectorstore,
+        max_batch_size=100,
+        max_batch_bytes=1500000,
+        max_concurrency=4,
+        value_decimals=6,
+        max_retries=3,
+        print_and_log=None,
+    ):
+        self.vectorstore = vectorstore
+        self.max_batch_size = max_batch_size
+        # Pinecone rejects requests over 2MB
+        self.max_batch_bytes = max_batch_bytes
+        self.value_decimals = value_decimals
+        self.max_retries = max_retries
+        self.print_and_log = print_and_log
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_concurrency)
+        )
+
+    def compact_vector(self, vector):
+        values = np.asarray(vector["values"], dtype=np.float64)
+        if self.value_decimals is not None:
+            # Rounded floats serialize to ~10 chars instead of ~20
+            values = np.round(values, self.value_decimals)
+        compacted = {"id": vector["id"], "values": values.tolist()}
+        # Pinecone doesn't accept null metadata values
+        metadata = {
+            key: value
+            for key, value in (vector.get("metadata") or {}).items()
+            if value is not None and value != ""
+        }
+        if metadata:
+            compacted["metadata"] = metadata
+        return compacted
+
+    def create_batches(self, vectors):
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for vector in vectors:
+            vector = self.compact_vector(vector)
+            vector_bytes = len(json.dumps(vector))
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or batch_bytes + vector_bytes > self.max_batch_bytes
+            ):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(vector)
+            batch_bytes += vector_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def upsert(self, vectors, namespace):
+        """Returns the number of vectors upserted. Raises if any batch still fails after retries."""
+        if not vectors:
+            return 0
+        start_time = time.time()
+        batches = self.create_batches(vectors)
+        futures = {
+            self.executor.submit(self.upsert_batch, batch, namespace): batch
+            for batch in batches
+        }
+        upserted_count = 0
+        failed_batches = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                upserted_count += future.result()
+            except Exception as error:
+                failed_batches.append((futures[future], error))
+
+        elapsed_seconds = max(time.time() - start_time, 1e-6)
+        if self.print_and_log:
+            self.print_and_log(
+                f"Upserted {upserted_count} vectors in {len(batches)} batches, {elapsed_seconds:.1f}s ({upserted_count / elapsed_seconds:.0f} vectors/s)"
+            )
+        if failed_batches:
+            failed_vector_count = sum(len(batch) for batch, _ in failed_batches)
+            raise RuntimeError(
+                f"{len(failed_batches)} of {len(batches)} upsert batches failed ({failed_vector_count} vectors): {failed_batches[0][1]}"
+            )
+        return upserted_count
+
+    def upsert_batch(self, batch, namespace):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.vectorstore.upsert(vectors=batch, namespace=namespace)
+                return getattr(response, "upserted_count", None) or len(batch)
+            except Exception as error:
+                if attempt == self.max_retries:
+                    raise
+                wait_seconds = min(30, 2**attempt) * (0.5 + random.random() / 2)
+                if self.print_and_log:
+                    self.print_and_log(
+                        f"Upsert batch of {len(batch)} failed ({error}), retrying in {wait_seconds:.1f}s"
+                    )
+                time.sleep(wait_seconds)
@@ -0,0 +1,208 @@
+"""
+Tests WebCrawler and HttpCache against a local aiohttp fixture server.
+
+Usage:
+    python -m pytest app/tests
+"""
+import os
+import sys
+import asyncio
+import threading
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.crawler_service import HttpCache, WebCrawler
+
+
+class FixtureServer:
+    """Serves pages with an ETag per body and answers If-None-Match with 304.
+    Paths in failing answer 500. Each request's path and conditional header are kept in requests.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.failing = set()
+        self.requests = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def handle(self, request):
+        self.requests.append((request.path, request.headers.get("If-None-Match")))
+        if request.path in self.failing:
+            return web.Response(status=500)
+        body = self.pages.get(request.path)
+        if body is None:
+            return web.Response(status=404)
+        etag = f'"{abs(hash(body))}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.runner.setup(), self.loop).result()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        asyncio.run_coroutine_threadsafe(site.start(), self.loop).result()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def server():
+    server = FixtureServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def crawler(tmp_path):
+    http_cache = HttpCache(str(tmp_path / "http_cache.sqlite3"))
+    crawler = WebCrawler(
+        http_cache,
+        "test_source",
+        lambda body: ("title", body),
+        max_retries=0,
+        print_and_log=lambda message: None,
+    )
+    yield crawler
+    http_cache.connection.close()
+
+
+def crawl(crawler, urls):
+    return list(crawler.lazy_load_urls(urls))
+
+
+def test_committed_page_is_revalidated_with_304(server, crawler):
+    server.pages["/a"] = "alpha"
+    url = f"{server.base_url}/a"
+
+    documents = crawl(crawler, [url])
+    assert documents[0].page_content == "alpha"
+    assert server.requests == [("/a", None)]
+    crawler.commit()
+
+    crawler.known_urls = {url}
+    documents = crawl(crawler, [url])
+    assert server.requests[-1][0] == "/a" and server.requests[-1][1] is not None
+    assert documents[0].metadata == {"source": url, "loc": url, "not_modified": True}
+
+
+def test_changed_page_is_parsed_again(server, crawler):
+    server.pages["/a"] = "alpha"
+    url = f"{server.base_url}/a"
+    crawl(crawler, [url])
+    crawler.commit()
+
+    server.pages["/a"] = "alpha v2"
+    crawler.known_urls = {url}
+    documents = crawl(crawler, [url])
+    assert documents[0].page_content == "alpha v2"
+    assert not documents[0].metadata.get("not_modified")
+
+
+def test_failed_fetch_falls_back_to_cached_copy(server, crawler):
+    server.pages["/a"] = "alpha"
+    url = f"{server.base_url}/a"
+    crawl(crawler, [url])
+    crawler.commit()
+
+    server.failing.add("/a")
+    crawler.known_urls = {url}
+    documents = crawl(crawler, [url])
+    assert documents[0].metadata.get("not_modified")
+
+    # Without chunks from the last run the cached body is parsed instead
+    crawler.known_urls = set()
+    documents = crawl(crawler, [url])
+    assert documents[0].page_content == "alpha"
+
+
+def test_failed_fetch_without_cache_yields_nothing(server, crawler):
+    server.failing.add("/a")
+    assert crawl(crawler, [f"{server.base_url}/a"]) == []
+
+
+def test_pending_pages_are_discarded_when_a_run_aborts(server, crawler):
+    server.pages["/a"] = "alpha"
+    server.pages["/b"] = "beta"
+    url_a = f"{server.base_url}/a"
+    url_b = f"{server.base_url}/b"
+
+    # The source's ingest fails after the crawl so commit() is never called
+    crawl(crawler, [url_a, url_b])
+    assert crawler.http_cache.get(url_a) is None
+    assert crawler.http_cache.get_pending_body("test_source", url_b) == "beta"
+
+    # The next run starts by discarding the staged pages and fetches unconditionally
+    crawler.known_urls = {url_a}
+    documents = crawl(crawler, [url_a])
+    assert server.requests[-1] == ("/a", None)
+    assert documents[0].page_content == "alpha"
+    assert crawler.http_cache.get_pending_body("test_source", url_b) is None
+
+    crawler.commit()
+    assert crawler.http_cache.get(url_a)["body"] == "alpha"
+    assert crawler.http_cache.get(url_b) is None
+
+
+def sitemap(base_url, lastmods):
+    urls = "".join(
+        f"<url><loc>{base_url}{path}</loc><lastmod>{lastmod}</lastmod></url>"
+        for path, lastmod in lastmods.items()
+    )
+    return f'<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+
+
+def crawl_sitemap(crawler, server):
+    return list(crawler.lazy_load_sitemap(f"{server.base_url}/sitemap.xml"))
+
+
+def test_unchanged_lastmod_skips_the_request(server, crawler):
+    server.pages["/sitemap.xml"] = sitemap(server.base_url, {"/a": "2023-01-01"})
+    server.pages["/a"] = "alpha"
+    url = f"{server.base_url}/a"
+    crawl_sitemap(crawler, server)
+    crawler.commit()
+
+    crawler.known_urls = {url}
+    server.requests.clear()
+    documents = crawl_sitemap(crawler, server)
+    assert [path for path, _ in server.requests] == ["/sitemap.xml"]
+    assert documents[0].metadata.get("not_modified")
+
+
+def test_failed_fetch_does_not_commit_its_new_lastmod(server, crawler):
+    server.pages["/sitemap.xml"] = sitemap(server.base_url, {"/a": "2023-01-01"})
+    server.pages["/a"] = "alpha"
+    url = f"{server.base_url}/a"
+    crawl_sitemap(crawler, server)
+    crawler.commit()
+    crawler.known_urls = {url}
+
+    # The page changes but its fetch fails, so the cached copy is used
+    server.pages["/sitemap.xml"] = sitemap(server.base_url, {"/a": "2023-02-01"})
+    server.pages["/a"] = "alpha v2"
+    server.failing.add("/a")
+    documents = crawl_sitemap(crawler, server)
+    assert documents[0].metadata.get("not_modified")
+    crawler.commit()
+    assert crawler.http_cache.get_lastmods("test_source").get(url) != "2023-02-01"
+
+    # The next run requests the page again instead of trusting the unchanged lastmod
+    server.failing.clear()
+    server.requests.clear()
+    documents = crawl_sitemap(crawler, server)
+    assert "/a" in [path for path, _ in server.requests]
+    assert documents[0].page_content == "alpha v2"
+    crawler.commit()
+    assert crawler.http_cache.get_lastmods("test_source")[url] == "2023-02-01"